@@ -4,32 +4,438 @@
 # For when sample names are stored in csv files at
 # a specific row/column and you need to compare it
 # to the file name.
+#
+#   python checkFileNames.py
+#   python checkFileNames.py "\\server\share\instrument" --workers 32
+#   python checkFileNames.py "\\server\share\instrument" --report samples.csv
+#   python checkFileNames.py "\\server\share\instrument" --watch --report mismatches.csv
+#   python checkFileNames.py output --manifest samples.json --report reconcile.csv
+#
+# The sample read from each file is kept in a small
+# SQLite index by path, size and modified time, so
+# checking the same folder again only opens the
+# files that are new or have changed.
 #################################################
 
-import os
+import argparse
 import csv
+import itertools
+import json
+import os
+import sqlite3
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+# Specify the directory path, every CSV file under it is checked
+DIRECTORY_PATH = r'C:\Users'
+
+# Files read at the same time. Reading is mostly waiting on the disk or
+# network share, so this can be well above the number of cores.
+WORKERS = 16
+
+# Index of the samples already read. Run with --no-cache to read every file.
+USE_CACHE = True
+CACHE_PATH = os.path.join(os.path.expanduser('~'), '.checkFileNames.sqlite')
+
+# --watch looks for new or changed files this often (seconds). A file is
+# checked once its size and modified time are the same on two looks in a row,
+# so files still being written by an instrument are left until they're done.
+POLL_INTERVAL = 5
+
+# Columns of the --report file, .csv or .jsonl, and of the report of a
+# --manifest cross-check
+REPORT_FIELDS = ['filename', 'filename_sample', 'file_sample', 'match']
+CROSS_CHECK_FIELDS = ['status', 'labcode', 'sample_name', 'filename', 'detail']
+
+
+def walk_csv_files(directory_path):
+    # Yield every CSV file under directory_path, subfolders included
+    folders = [directory_path]
+    while folders:
+        folder = folders.pop()
+        try:
+            with os.scandir(folder) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.name.lower().endswith('.csv'):
+                        yield entry
+        except OSError as e:
+            print(f"Error reading folder '{folder}': {e}")
+
+
+def parse_filename_sample(filename):
+    # The sample name is the fourth _-separated part of the file name
+    parts = filename.split("_")
+    if len(parts) < 4:
+        return None
+    return parts[3].replace(".csv", "").replace("-1", "")
+
+
+def read_file_sample(path):
+    # The sample name is in the third row, fourth column, so the rest of the
+    # file is never read
+    with open(path, 'r', newline='') as csvfile:
+        rows = list(itertools.islice(csv.reader(csvfile), 3))
+
+    if len(rows) > 2 and len(rows[2]) > 3:
+        return rows[2][3]
+    return None
+
+
+def scan_file(path):
+    # Returns the sample in the file, and whether the file could be read
+    try:
+        return read_file_sample(path), True
+    except (OSError, UnicodeDecodeError, csv.Error) as e:
+        print(f"Error reading file '{path}': {e}")
+        return None, False
+
+
+def open_cache(cache_path):
+    cache = sqlite3.connect(cache_path)
+    cache.execute(
+        "CREATE TABLE IF NOT EXISTS files ("
+        "path TEXT PRIMARY KEY, directory TEXT, size INTEGER, mtime_ns INTEGER, "
+        "file_sample TEXT, seen INTEGER)")
+    return cache
+
+
+def file_signature(entry):
+    # Size and modified time, which change whenever the file is rewritten
+    try:
+        file_stat = entry.stat()
+        return file_stat.st_size, file_stat.st_mtime_ns
+    except OSError:
+        return None
+
+
+def lookup_sample(cache, path, signature, run_id):
+    # The cached sample as a 1-tuple if the file is unchanged, otherwise None.
+    # Files found are marked with this run so the rest can be pruned.
+    row = cache.execute("SELECT size, mtime_ns, file_sample FROM files WHERE path = ?",
+                        (path,)).fetchone()
+    if row is None or signature is None or tuple(row[:2]) != signature:
+        return None
+    cache.execute("UPDATE files SET seen = ? WHERE path = ?", (run_id, path))
+    return (row[2],)
+
+
+def store_sample(cache, directory_path, path, signature, file_sample_info, run_id):
+    cache.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?)",
+                  (path, directory_path, *signature, file_sample_info, run_id))
+
+
+def prune_cache(cache, directory_path, run_id):
+    # Forget the files under this folder that weren't found this time
+    cache.execute("DELETE FROM files WHERE directory = ? AND seen != ?", (directory_path, run_id))
+    cache.commit()
+
+
+def scan_files(directory_path, workers=WORKERS, cache=None, totals=None):
+    # Yield (path, sample from the file name, sample in the file) as each file
+    # is read. Only a few files per worker are queued at once, so memory stays
+    # flat however many files there are. With a cache, unchanged files are
+    # answered from it without being opened.
+    directory_path = os.path.abspath(directory_path)
+    run_id = time.time_ns()
+    totals = totals if totals is not None else {}
+    totals.update(read=0, cached=0)
+
+    files = walk_csv_files(directory_path)
+    walked = False
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = {}
+            while True:
+                entry = next(files, None)
+                if entry is not None:
+                    signature = file_signature(entry) if cache else None
+                    cached = lookup_sample(cache, entry.path, signature, run_id) if cache else None
+                    if cached is not None:
+                        totals['cached'] += 1
+                        yield entry.path, parse_filename_sample(entry.name), cached[0]
+                        continue
+                    pending[executor.submit(scan_file, entry.path)] = (entry, signature)
+                if not pending:
+                    break
+                if entry is not None and len(pending) < workers * 4:
+                    continue
+
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry, signature = pending.pop(future)
+                    file_sample_info, read = future.result()
+                    totals['read'] += 1
+                    if cache and read and signature:
+                        store_sample(cache, directory_path, entry.path, signature,
+                                     file_sample_info, run_id)
+                    yield entry.path, parse_filename_sample(entry.name), file_sample_info
+        walked = True
+    finally:
+        # A stopped scan still keeps the samples read so far, but only a
+        # complete one shows which files are gone
+        if cache and walked:
+            prune_cache(cache, directory_path, run_id)
+        elif cache:
+            cache.commit()
+
+
+def snapshot(directory_path):
+    # Size and modified time of every CSV file under directory_path
+    return {entry.path: file_signature(entry) for entry in walk_csv_files(directory_path)}
+
+
+def watch_files(directory_path, interval=POLL_INTERVAL, cache=None):
+    # Yield (path, sample from the file name, sample in the file) for each
+    # file that appears or changes after watching starts, once it has stopped
+    # changing. Only the folder listing is compared between looks, files are
+    # opened once.
+    directory_path = os.path.abspath(directory_path)
+    known = snapshot(directory_path)
+    changing = {}
+    print(f"Watching {directory_path} for new CSV files, press Ctrl+C to stop.")
+
+    while True:
+        time.sleep(interval)
+        current = snapshot(directory_path)
+
+        for path, signature in current.items():
+            if signature is None or known.get(path) == signature:
+                continue
+            if changing.get(path) != signature:
+                # New, or still being written, look again next time
+                changing[path] = signature
+                continue
+
+            del changing[path]
+            known[path] = signature
+            file_sample_info, read = scan_file(path)
+            if cache and read:
+                store_sample(cache, directory_path, path, signature, file_sample_info,
+                             time.time_ns())
+                cache.commit()
+            yield path, parse_filename_sample(os.path.basename(path)), file_sample_info
+
+        # Forget files that were removed
+        for path in set(known) - set(current):
+            del known[path]
+        for path in set(changing) - set(current):
+            del changing[path]
+
+
+def load_manifest(json_file_path):
+    # The generateCSVFromTemplate items, keyed by labcode and sample name.
+    # Imported here so the script runs on its own when --manifest isn't used
+    from generateCSVFromTemplate import iter_json_items
+
+    return {(str(item['labcode']), str(item['sample_name'])): item
+            for item in iter_json_items(json_file_path)}
+
+
+def parse_output_filename(filename):
+    # cupno, date, labcode and sample name from the name of a generated file,
+    # None if it isn't named like one
+    from generateCSVFromTemplate import FILENAME_PREFIX
+
+    name, extension = os.path.splitext(filename)
+    parts = name.split('_', 3)
+    if extension.lower() != '.csv' or len(parts) < 4 or not parts[0].startswith(FILENAME_PREFIX):
+        return None
+    return parts[0][len(FILENAME_PREFIX):], parts[1], parts[2], parts[3]
+
+
+def cross_check(results, items, write_row=None):
+    # Match every scanned file to its item, then list the items no file was
+    # found for. When an item has several files, the one in the right batch
+    # folder with the right cupno is taken and the others are extra, whatever
+    # order they were scanned in. Returns the number of files and items per
+    # status.
+    counts = {'ok': 0, 'inconsistent': 0, 'extra': 0, 'missing': 0}
+    # (labcode, sample name) -> [(rank, path, problems)] for each file found
+    candidates = {}
+
+    def report(status, labcode, sample_name, path, detail):
+        counts[status] += 1
+        if write_row:
+            write_row({'status': status, 'labcode': labcode, 'sample_name': sample_name,
+                       'filename': path, 'detail': detail})
+        if status != 'ok':
+            print(f"{status.capitalize()}: {path or f'{labcode}/{sample_name}'} ({detail})")
+
+    try:
+        for path, _, file_sample_info in results:
+            parsed = parse_output_filename(os.path.basename(path))
+            if parsed is None:
+                report('extra', None, None, path, "not named like a generated file")
+                continue
+
+            cupno, _, labcode, sample_name = parsed
+            key = (labcode, sample_name)
+            item = items.get(key)
+            if item is None:
+                report('extra', labcode, sample_name, path, "no item in the manifest")
+                continue
+
+            batch = os.path.basename(os.path.dirname(path))
+            batch_problem = batch != str(item['batch'])
+            cupno_problem = cupno != str(item['cupno'])
+            sample_problem = file_sample_info != sample_name
+            problems = []
+            if cupno_problem:
+                problems.append(f"cupno {cupno}, expected {item['cupno']}")
+            if batch_problem:
+                problems.append(f"in folder {batch}, expected {item['batch']}")
+            if sample_problem:
+                problems.append(f"sample in the file is {file_sample_info}")
+            rank = (batch_problem, cupno_problem, sample_problem, path)
+            candidates.setdefault(key, []).append((rank, path, problems))
+    except KeyboardInterrupt:
+        print("Stopped, items not reached yet are listed as missing.")
+
+    for (labcode, sample_name), found in candidates.items():
+        (_, path, problems), *others = sorted(found)
+        report('inconsistent' if problems else 'ok', labcode, sample_name, path,
+               '; '.join(problems))
+        for _, other_path, _ in others:
+            report('extra', labcode, sample_name, other_path,
+                   f"another file was found for this item: {path}")
+
+    for key, item in items.items():
+        if key not in candidates:
+            report('missing', *key, None, f"batch {item['batch']}, cupno {item['cupno']}")
+
+    return counts
+
+
+def open_report(report_path, append=False, fieldnames=REPORT_FIELDS):
+    # The report is written a row at a time as files are scanned. Returns the
+    # file to close and the function that writes a row to it. When appending,
+    # as --watch does, each row is flushed straight away.
+    new_file = not append or not os.path.exists(report_path) or os.path.getsize(report_path) == 0
+    report_file = open(report_path, 'a' if append else 'w', newline='')
+
+    if report_path.lower().endswith('.jsonl'):
+        def write(row):
+            report_file.write(json.dumps(row) + '\n')
+    else:
+        writer = csv.DictWriter(report_file, fieldnames=fieldnames)
+        if new_file:
+            writer.writeheader()
+        write = writer.writerow
+
+    if not append:
+        return report_file, write
+
+    def write_row(row):
+        write(row)
+        report_file.flush()
+
+    return report_file, write_row
+
+
+def check_files(results, write_row=None):
+    # Report every result, show only the mismatches, and return the counts
+    # Stopping with Ctrl+C still returns the counts so far
+    checked = mismatched = 0
+
+    try:
+        for path, filename_sample_info, file_sample_info in results:
+            match = filename_sample_info is not None and filename_sample_info == file_sample_info
+            checked += 1
+            if write_row:
+                write_row({'filename': path, 'filename_sample': filename_sample_info,
+                           'file_sample': file_sample_info, 'match': match})
+            if not match:
+                mismatched += 1
+                print(f"Mismatch: {path} (file name: {filename_sample_info}, "
+                      f"file: {file_sample_info})")
+    except KeyboardInterrupt:
+        print("Stopped.")
+
+    return checked, mismatched
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the sample name in each CSV file name to the one inside the file.')
+    parser.add_argument('directory', nargs='?', default=DIRECTORY_PATH,
+                        help=f'folder to check, subfolders included (default {DIRECTORY_PATH})')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help=f'files to read at the same time (default {WORKERS})')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write every file checked to a .csv or .jsonl report')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='read every file, even if it is unchanged since the last check')
+    parser.add_argument('--cache', metavar='FILE', default=CACHE_PATH,
+                        help=f'index of samples already read (default {CACHE_PATH})')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep checking new files as they arrive, appending them to --report')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help=f'seconds between looks for new files with --watch (default {POLL_INTERVAL})')
+    parser.add_argument('--manifest', metavar='JSON_FILE',
+                        help='cross-check the folder against the generateCSVFromTemplate JSON '
+                             'it was generated from, listing missing, extra and inconsistent files')
+    args = parser.parse_args()
 
-# Specify the directory path
-directory_path = r'C:\Users'
+    if not os.path.isdir(args.directory):
+        print(f"Error: '{args.directory}' is not a folder.")
+        exit(1)
+    if args.manifest and args.watch:
+        print("Error: --manifest can't be used with --watch.")
+        exit(1)
 
-# Get a list of filenames in the directory
-filenames = os.listdir(directory_path)
+    if args.manifest:
+        try:
+            items = load_manifest(args.manifest)
+        except FileNotFoundError:
+            print(f"Error: JSON file '{args.manifest}' not found.")
+            exit(1)
+        except (json.JSONDecodeError, KeyError, TypeError):
+            print(f"Error: '{args.manifest}' is not a valid generateCSVFromTemplate JSON file.")
+            exit(1)
 
-sample_info = []
+    cache = open_cache(args.cache) if USE_CACHE and not args.no_cache else None
+    totals = {}
 
-# Print the filenames
-for filename in filenames:
-    filename_sample_info = filename.split(
-        "_")[3].replace(".csv", "").replace("-1", "")
-    with open(os.path.join(directory_path, filename), 'r') as csvfile:
-        reader = csv.reader(csvfile)
-        data = list(reader)
+    if args.manifest:
+        report_file, write_row = (open_report(args.report, fieldnames=CROSS_CHECK_FIELDS)
+                                  if args.report else (None, None))
+        try:
+            counts = cross_check(scan_files(args.directory, args.workers, cache, totals),
+                                 items, write_row)
+        finally:
+            if report_file:
+                report_file.close()
+            if cache:
+                cache.close()
 
-        if len(data) > 2:
-            if len(data[2]) > 3:
-                file_sample_info = data[2][3]
+        print(f"{counts['ok']} files match their items, {counts['inconsistent']} inconsistent, "
+              f"{counts['extra']} extra, {counts['missing']} items missing.")
+        if args.report:
+            print(f"Report saved to: {args.report}")
+        return
+    report_file, write_row = open_report(args.report, args.watch) if args.report else (None, None)
+    try:
+        if args.watch:
+            results = watch_files(args.directory, args.interval, cache)
+        else:
+            results = scan_files(args.directory, args.workers, cache, totals)
+        checked, mismatched = check_files(results, write_row)
+    finally:
+        if report_file:
+            report_file.close()
+        if cache:
+            cache.close()
 
-    sample_info.append((filename_sample_info, file_sample_info))
+    if args.watch:
+        print(f"Checked {checked} new files, {mismatched} mismatched.")
+    else:
+        print(f"Checked {checked} files ({totals.get('cached', 0)} unchanged since the last check), "
+              f"{mismatched} mismatched.")
+    if args.report:
+        print(f"Report saved to: {args.report}")
 
 
-print(sample_info)
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,351 @@
 import json
 import csv
+import hashlib
+import io
+import itertools
+import locale
 import os
 import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
+from functools import lru_cache
 
+# Items sent to a worker at a time, and how much of the JSON file to read at once
+BATCH_SIZE = 200
+READ_SIZE = 64 * 1024
+# Templates kept ready in each process
+TEMPLATE_CACHE_SIZE = 32
+
+# Files are written in the same encoding the templates are read in
+ENCODING = locale.getpreferredencoding(False)
+
+# Generated files are named FILENAME_PREFIX{cupno}_{date}_{labcode}_{sample_name}.csv
+FILENAME_PREFIX = 'StarLIMSV11'
+
+# Archive formats for writing each batch to one file instead of a folder
+ARCHIVE_FORMATS = ['zip', 'tar', 'tar.gz']
+MANIFEST_FILENAME = 'manifest.csv'
+
+# With --incremental, the content hash and file of every item generated so far
+# are kept here in the output directory, so unchanged items can be skipped
+GENERATED_FILENAME = '.generated.json'
+
+# Every item needs these, and its date and time in these formats
+REQUIRED_FIELDS = ['file_template', 'cupno', 'labcode', 'batch', 'sample_name',
+                   'acquisition_date', 'acquisition_time', 'operator', 'instrument']
+# Fields that become part of a file or folder name
+TEXT_FIELDS = ['file_template', 'cupno', 'labcode', 'batch', 'sample_name']
+DATE_FORMAT = '%m/%d/%y'
+TIME_FORMAT = '%H:%M:%S'
+
+# Output folders already made, per process
+created_dirs = set()
+
+
+def iter_json_items(json_file_path):
+    # Yield the items of a JSON array (or of a JSON Lines file) one at a time,
+    # so the whole file never has to be held in memory
+    with open(json_file_path, 'r') as json_file:
+        if json_file_path.lower().endswith(('.jsonl', '.ndjson')):
+            for line in json_file:
+                if line.strip():
+                    yield json.loads(line)
+            return
+
+        decoder = json.JSONDecoder()
+        buffer = ''
+        while not buffer:
+            more = json_file.read(READ_SIZE)
+            buffer = more.lstrip()
+            if not more:
+                break
+        if not buffer.startswith('['):
+            raise json.JSONDecodeError("Expected a JSON array", buffer, 0)
+        position = 1
+        end_of_file = False
+        expect_item = True
+        item_count = 0
+
+        while True:
+            # Skip whitespace, reading more of the file when the buffer runs out
+            while True:
+                while position < len(buffer) and buffer[position] in ' \t\r\n':
+                    position += 1
+                if position < len(buffer) or end_of_file:
+                    break
+                more = json_file.read(READ_SIZE)
+                end_of_file = not more
+                buffer = buffer[position:] + more
+                position = 0
+            char = buffer[position:position + 1]
+
+            if char == ']' and (not expect_item or item_count == 0):
+                # Only whitespace may follow the closing bracket
+                rest = buffer[position + 1:]
+                while True:
+                    if rest.strip():
+                        raise json.JSONDecodeError("Extra data after the JSON array", rest, 0)
+                    rest = json_file.read(READ_SIZE)
+                    if not rest:
+                        return
+            if not expect_item:
+                if char != ',':
+                    raise json.JSONDecodeError("Expected ',' or ']'", buffer, position)
+                position += 1
+                expect_item = True
+                continue
+            if char in ('', ',', ']'):
+                raise json.JSONDecodeError("Expected an array item", buffer, position)
+
+            try:
+                item, item_end = decoder.raw_decode(buffer, position)
+                # An item is only complete once something follows it. A number
+                # cut off after its '.', 'e' or sign decodes early, so that
+                # counts as cut off too.
+                if not end_of_file and not buffer[item_end:].strip('.eE+-'):
+                    raise json.JSONDecodeError("Item may continue", buffer, item_end)
+            except json.JSONDecodeError:
+                if end_of_file:
+                    raise
+                # Keep the unread part and read some more of the file
+                more = json_file.read(READ_SIZE)
+                end_of_file = not more
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+
+            yield item
+            item_count += 1
+            position = item_end
+            expect_item = False
+
+
+def encode_rows(rows):
+    # CSV rows as the bytes csv.writer would write for them
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    return buffer.getvalue().encode(ENCODING)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def read_template(template_path):
+    # Only the third line changes between files, so keep the lines before and
+    # after it encoded and ready to write
+    with open(template_path, 'r', newline='') as template_csv:
+        csv_data = list(csv.reader(template_csv))
+    if len(csv_data) < 3:
+        raise ValueError(f"Template CSV file '{template_path}' has fewer than 3 lines.")
+    return encode_rows(csv_data[:2]), encode_rows(csv_data[3:])
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def template_hash(template_path):
+    head, tail = read_template(template_path)
+    return hashlib.sha256(head + tail).hexdigest()
+
+
+def item_key(item):
+    # What identifies an item's output file from one run to the next (the
+    # file name also has the date in it)
+    return '|'.join(str(item[field]) for field in ['batch', 'cupno', 'labcode', 'sample_name'])
+
+
+def item_hash(item, template_dir):
+    # Changes when anything in the item or its template changes
+    content = json.dumps(item, sort_keys=True) + template_hash(
+        os.path.join(template_dir, item['file_template']))
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def output_filename(item, today):
+    return f"{FILENAME_PREFIX}{item['cupno']}_{today}_{item['labcode']}_{item['sample_name']}.csv"
+
+
+def load_generated(generated_filepath):
+    try:
+        with open(generated_filepath) as generated_file:
+            return json.load(generated_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_generated(generated, generated_filepath):
+    # Write to a temporary file first so an interrupted run can't leave it half written
+    with open(generated_filepath + '.tmp', 'w') as generated_file:
+        json.dump(generated, generated_file)
+    os.replace(generated_filepath + '.tmp', generated_filepath)
+
+
+def generate_csv_file(item, template_dir, output_dir, today, archive_format=None):
+    # Write the CSV for one item. Returns the path it was written to, the
+    # error if it couldn't be, and when writing archives, the file for the
+    # main process to add to its batch's archive instead
+    template_file = item['file_template']
+    template_path = os.path.join(template_dir, template_file)
+    new_filename = output_filename(item, today)
+    output_path = os.path.join(output_dir, item['batch'], new_filename)
 
-def generate_csv_files(json_file_path, template_dir, output_dir):
     try:
-        # Load JSON data
-        with open(json_file_path, 'r') as json_file:
-            data = json.load(json_file)
+        # Read the template CSV file
+        head, tail = read_template(template_path)
+    except FileNotFoundError:
+        return output_path, f"Error: Template CSV file '{template_path}' not found.", None
+    except ValueError as e:
+        return output_path, f"Error: {e}", None
+
+    # Replace the third line (index 2) with new values
+    row = encode_rows([[
+        'TRUE',
+        item['labcode'],
+        item['batch'],
+        item['sample_name'],
+        item['acquisition_date'],
+        item['acquisition_time'],
+        item['operator'],
+        item['instrument'],
+        '',
+        ''
+    ]])
+
+    if archive_format:
+        return output_path, None, (item['batch'], item['labcode'], item['sample_name'],
+                                   new_filename, head + row + tail)
+
+    # Create output directory if it doesn't exist
+    batch_output_dir = os.path.dirname(output_path)
+    if batch_output_dir not in created_dirs:
+        os.makedirs(batch_output_dir, exist_ok=True)
+        created_dirs.add(batch_output_dir)
+
+    try:
+        # Write the updated data to the new CSV file
+        with open(output_path, 'wb') as new_csv:
+            new_csv.write(head + row + tail)
+        return output_path, None, None
+    except IOError as e:
+        return output_path, f"Error writing file '{output_path}': {e}", None
+
+
+def generate_batch(items, template_dir, output_dir, today, archive_format=None):
+    # Run in a worker process: write the CSVs for a batch of items
+    return [generate_csv_file(item, template_dir, output_dir, today, archive_format)
+            for item in items]
+
+
+def open_archive(archive_path, archive_format):
+    # A zip or tar archive that files are streamed into as they are generated
+    if archive_format == 'zip':
+        return zipfile.ZipFile(archive_path, 'w', compression=zipfile.ZIP_DEFLATED)
+    return tarfile.open(archive_path, 'w:gz' if archive_format == 'tar.gz' else 'w')
+
+
+def add_to_archive(archive, filename, content):
+    if isinstance(archive, zipfile.ZipFile):
+        archive.writestr(filename, content)
+    else:
+        file_info = tarfile.TarInfo(filename)
+        file_info.size = len(content)
+        file_info.mtime = time.time()
+        archive.addfile(file_info, io.BytesIO(content))
+
+
+def close_archives(archives):
+    # Add each archive's manifest of the files in it, then close it
+    for archive, manifest_rows in archives.values():
+        add_to_archive(archive, MANIFEST_FILENAME,
+                       encode_rows([['labcode', 'sample_name', 'filename']] + manifest_rows))
+        archive.close()
+
+
+def skip_unchanged(items, template_dir, output_dir, today, generated, waiting):
+    # Pass on only the items that are new or changed since they were last
+    # generated, noting by output path the key and hash each will be recorded with
+    for item in items:
+        key = item_key(item)
+        try:
+            content_hash = item_hash(item, template_dir)
+        except (FileNotFoundError, ValueError):
+            # Let the generator report the template problem
+            yield item
+            continue
+
+        previous = generated.get(key)
+        if previous and previous['hash'] == content_hash and os.path.exists(previous['path']):
+            print(f"Unchanged: {previous['path']}")
+            continue
+
+        output_path = os.path.join(output_dir, item['batch'], output_filename(item, today))
+        waiting[output_path] = (key, content_hash)
+        yield item
+
+
+def matches_format(value, date_format):
+    try:
+        datetime.strptime(str(value), date_format)
+        return True
+    except ValueError:
+        return False
+
+
+def validate_items(items, template_dir, today):
+    # Check every item in one pass before anything is written, and return all
+    # the problems found. Each template is only checked once.
+    problems = []
+    template_problems = {}
+    output_paths = {}
+
+    for number, item in enumerate(items, start=1):
+        if not isinstance(item, dict):
+            problems.append(f"Item {number} is not a JSON object.")
+            continue
+
+        missing = [field for field in REQUIRED_FIELDS if item.get(field) in (None, '')]
+        if missing:
+            problems.append(f"Item {number} is missing {', '.join(missing)}.")
+        not_text = [field for field in TEXT_FIELDS
+                    if item.get(field) not in (None, '') and not isinstance(item[field], str)]
+        for field in not_text:
+            problems.append(f"Item {number} has {field} {json.dumps(item[field])}, expected a string.")
+        if item.get('acquisition_date') and not matches_format(item['acquisition_date'], DATE_FORMAT):
+            problems.append(f"Item {number} has acquisition_date '{item['acquisition_date']}', "
+                            f"expected MM/DD/YY.")
+        if item.get('acquisition_time') and not matches_format(item['acquisition_time'], TIME_FORMAT):
+            problems.append(f"Item {number} has acquisition_time '{item['acquisition_time']}', "
+                            f"expected HH:MM:SS.")
+
+        template_file = item.get('file_template')
+        if template_file and 'file_template' not in not_text \
+                and template_file not in template_problems:
+            template_path = os.path.join(template_dir, template_file)
+            try:
+                read_template(template_path)
+                template_problems[template_file] = None
+            except FileNotFoundError:
+                template_problems[template_file] = f"Template CSV file '{template_path}' not found"
+            except ValueError as e:
+                template_problems[template_file] = str(e).rstrip('.')
+            if template_problems[template_file]:
+                problems.append(f"{template_problems[template_file]} (first used by item {number}).")
+
+        if all(isinstance(item.get(field), str) and item[field]
+               for field in ['batch', 'cupno', 'labcode', 'sample_name']):
+            output_path = os.path.join(item['batch'], output_filename(item, today))
+            if output_path in output_paths:
+                problems.append(f"Item {number} would overwrite item {output_paths[output_path]}'s "
+                                f"file '{output_path}'.")
+            else:
+                output_paths[output_path] = number
+
+    return problems
+
+
+def validate_json_file(json_file_path, template_dir, today):
+    # Stop before generating anything if any item has a problem
+    try:
+        problems = validate_items(iter_json_items(json_file_path), template_dir, today)
     except FileNotFoundError:
         print(f"Error: JSON file '{json_file_path}' not found.")
         sys.exit(1)
@@ -17,68 +353,149 @@ def generate_csv_files(json_file_path, template_dir, output_dir):
         print(f"Error: Invalid JSON format in file '{json_file_path}'.")
         sys.exit(1)
 
-    # Process each object in the JSON data
-    for item in data:
-        template_file = item['file_template']
-        template_path = os.path.join(template_dir, template_file)
+    if problems:
+        for problem in problems:
+            print(f"Error: {problem}")
+        print(f"Found {len(problems)} problem(s) in '{json_file_path}', no files were generated.")
+        sys.exit(1)
 
-        try:
-            # Read the template CSV file
-            with open(template_path, 'r', newline='') as template_csv:
-                reader = csv.reader(template_csv)
-                csv_data = list(reader)
-        except FileNotFoundError:
-            print(f"Error: Template CSV file '{template_path}' not found.")
-            continue  # Skip this item and continue with the next
-
-        # Update the third line (index 2) with new values
-        csv_data[2] = [
-            'TRUE',
-            item['labcode'],
-            item['batch'],
-            item['sample_name'],
-            item['acquisition_date'],
-            item['acquisition_time'],
-            item['operator'],
-            item['instrument'],
-            '',
-            ''
-        ]
-
-        # Create output directory if it doesn't exist
-        batch_output_dir = os.path.join(output_dir, item['batch'])
-        os.makedirs(batch_output_dir, exist_ok=True)
 
-        # Generate the new filename
-        today = datetime.now().strftime('%Y%m%d')
-        new_filename = f"StarLIMSV11{item['cupno']}_{today}_{item['labcode']}_{item['sample_name']}.csv"
-        output_path = os.path.join(batch_output_dir, new_filename)
+def generate_csv_files(json_file_path, template_dir, output_dir, workers=1, archive_format=None,
+                       incremental=False, check_only=False):
+    if incremental and archive_format:
+        print("Error: --incremental can't be used with --archive, archives are rewritten every run.")
+        sys.exit(1)
 
-        try:
-            # Write the updated data to the new CSV file
-            with open(output_path, 'w', newline='') as new_csv:
-                writer = csv.writer(new_csv)
-                writer.writerows(csv_data)
-            print(f"Generated: {output_path}")
-        except IOError as e:
-            print(f"Error writing file '{output_path}': {e}")
+    # The date is the same for every file of a run
+    today = datetime.now().strftime('%Y%m%d')
+
+    validate_json_file(json_file_path, template_dir, today)
+    if check_only:
+        print(f"No problems found in '{json_file_path}'.")
+        return
+
+    items = iter_json_items(json_file_path)
+
+    # Each batch's archive and manifest rows, when writing archives
+    archives = {}
+    if archive_format or incremental:
+        os.makedirs(output_dir, exist_ok=True)
+
+    # Hashes of what was generated before, and of the items now being generated
+    generated_filepath = os.path.join(output_dir, GENERATED_FILENAME)
+    generated = load_generated(generated_filepath) if incremental else {}
+    waiting = {}
+    if incremental:
+        items = skip_unchanged(items, template_dir, output_dir, today, generated, waiting)
+
+    def handle_result(result):
+        output_path, error, entry = result
+        recorded = waiting.pop(output_path, None)
+        if error:
+            print(error)
+            return
+
+        if entry:
+            batch, labcode, sample_name, filename, content = entry
+            archive_path = os.path.join(output_dir, f"{batch}.{archive_format}")
+            try:
+                if batch not in archives:
+                    archives[batch] = (open_archive(archive_path, archive_format), [])
+                archive, manifest_rows = archives[batch]
+                add_to_archive(archive, filename, content)
+                manifest_rows.append([labcode, sample_name, filename])
+                print(f"Generated: {archive_path}/{filename}")
+            except IOError as e:
+                print(f"Error writing file '{archive_path}': {e}")
+            return
+
+        print(f"Generated: {output_path}")
+        if recorded:
+            key, content_hash = recorded
+            # A changed item generated on a later day replaces its older file
+            previous = generated.get(key)
+            if previous and previous['path'] != output_path and os.path.exists(previous['path']):
+                os.remove(previous['path'])
+            generated[key] = {'hash': content_hash, 'path': output_path}
+
+    try:
+        if workers == 1:
+            for item in items:
+                handle_result(generate_csv_file(item, template_dir, output_dir, today,
+                                                archive_format))
+            return
+
+        # Hand out batches of items, keeping only a few batches waiting at a
+        # time so memory stays flat however long the JSON file is
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+            while True:
+                batch = list(itertools.islice(items, BATCH_SIZE))
+                if batch:
+                    pending.add(executor.submit(
+                        generate_batch, batch, template_dir, output_dir, today, archive_format))
+                if not pending:
+                    break
+                if batch and len(pending) < workers * 2:
+                    continue
+
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    for result in future.result():
+                        handle_result(result)
+    except FileNotFoundError:
+        print(f"Error: JSON file '{json_file_path}' not found.")
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Error: Invalid JSON format in file '{json_file_path}'.")
+        sys.exit(1)
+    finally:
+        close_archives(archives)
+        if incremental:
+            save_generated(generated, generated_filepath)
 
 
 def display_help(script_name):
     print(f"Usage:")
-    print(f"  python {script_name} <json_file_path> <template_directory>")
+    print(f"  python {script_name} <json_file_path> <template_directory> [--workers N] [--archive FORMAT] [--incremental] [--check]")
     print(f"  python {script_name} --help")
     print(f"  python {script_name} -h")
     print(f"  python {script_name} --generate-template [filename]")
     print(f"  python {script_name} -g [filename]")
     print("\nOptions:")
-    print("  <json_file_path>        Path to the JSON file containing the data for CSV generation")
+    print("  <json_file_path>        Path to the JSON (array) or JSON Lines (.jsonl) file containing the data for CSV generation")
     print("  <template_directory>    Directory containing the template CSV files")
+    print("  --workers N, -w N       Generate the files in N processes (default: 1)")
+    print("  --archive FORMAT, -a    Write each batch to one zip, tar or tar.gz archive with a manifest.csv,")
+    print("                          instead of a folder of CSV files")
+    print("  --incremental, -i       Only generate items that are new or changed since the last run")
+    print("  --check, -c             Only check the JSON file for problems, without generating anything")
     print("  --help, -h              Display this help message")
     print("  --generate-template, -g Generate a template JSON file")
     print("  [filename]              Optional: Specify a name for the generated template file (default: template.json)")
 
 
+def parse_options(args):
+    # Options after the JSON file and template directory, None if any are invalid
+    options = {'workers': 1, 'archive_format': None, 'incremental': False, 'check_only': False}
+    args = list(args)
+
+    while args:
+        option = args.pop(0)
+        if option in ['--workers', '-w'] and args and args[0].isdigit() and int(args[0]) > 0:
+            options['workers'] = int(args.pop(0))
+        elif option in ['--archive', '-a'] and args and args[0] in ARCHIVE_FORMATS:
+            options['archive_format'] = args.pop(0)
+        elif option in ['--incremental', '-i']:
+            options['incremental'] = True
+        elif option in ['--check', '-c']:
+            options['check_only'] = True
+        else:
+            return None
+
+    return options
+
+
 def generate_json_template(filename='template.json'):
     template = [{
         "file_template": "example_template.csv",
@@ -115,13 +532,13 @@ if __name__ == "__main__":
             generate_json_template(sys.argv[2])
         else:
             generate_json_template()
-    elif len(sys.argv) == 3:
+    elif len(sys.argv) >= 3 and parse_options(sys.argv[3:]) is not None:
         json_file_path = sys.argv[1]
         template_dir = sys.argv[2]
         output_dir = "output"  # You can change this to your preferred output directory
-        generate_csv_files(json_file_path, template_dir, output_dir)
+        generate_csv_files(json_file_path, template_dir, output_dir, **parse_options(sys.argv[3:]))
     else:
-        print("Error: Invalid number of arguments.")
+        print("Error: Invalid arguments.")
         print(
             f"Use 'python {script_name} --help' or 'python {script_name} -h' for usage information.")
         sys.exit(1)
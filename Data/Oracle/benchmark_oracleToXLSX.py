@@ -0,0 +1,346 @@
+#################################################
+# Benchmarks the oracleToXLSX export pipeline
+#
+# Runs the real fetch and write functions against an
+# in-process stand-in for Oracle that returns synthetic
+# rows, so no database is needed. Reports wall time,
+# rows/sec and peak memory per stage for each
+# pagination, fetch and output mode.
+#
+#   python benchmark_oracleToXLSX.py
+#   python benchmark_oracleToXLSX.py --rows 100000 --chunk-size 1000 10000
+#   python benchmark_oracleToXLSX.py --cases keyset parquet --json results.jsonl
+#################################################
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import oracleToXLSX as export
+
+try:
+    import oracledb
+except ImportError as e:
+    missing_package = str(e).split()[-1]
+    print(f"Missing required package: {missing_package}.")
+    print(f"pip install {missing_package}")
+    exit(1)
+
+ROW_COUNTS = [10_000, 1_000_000]
+
+# Cases that only fetch (the rows are thrown away) and cases that fetch by
+# streaming and then write in one of the output formats
+FETCH_CASES = ['offset', 'keyset', 'stream', 'hash4', 'range4']
+WRITE_CASES = ['xlsx', 'xlsx-pandas', 'parquet', 'feather', 'csv.gz']
+
+# Cases left out above this many rows unless named with --cases: offset
+# generates every skipped row again (hours at 10M), and pandas can't put
+# more than one sheet's worth of rows in a workbook
+LARGE_ROWS = 1_000_000
+SMALL_CASES = ['offset', 'xlsx-pandas']
+
+START_DATE = datetime(2024, 1, 1)
+
+DESCRIPTION = [
+    ('ID', oracledb.DB_TYPE_NUMBER, 12, 22, 12, 0, False),
+    ('SAMPLE_NAME', oracledb.DB_TYPE_VARCHAR, 20, 20, None, None, True),
+    ('RESULT', oracledb.DB_TYPE_NUMBER, 12, 22, 12, 4, True),
+    ('COLLECTED', oracledb.DB_TYPE_DATE, 23, None, None, None, True),
+    ('STATUS', oracledb.DB_TYPE_VARCHAR, 10, 10, None, None, True)
+]
+
+
+def make_row(row_id):
+    # One synthetic row, the same every time for the same id
+    return (
+        row_id,
+        f'SAMPLE{row_id:010}',
+        None if row_id % 11 == 0 else row_id * 0.25,
+        START_DATE + timedelta(seconds=row_id),
+        'DONE' if row_id % 3 else 'PENDING'
+    )
+
+
+class FakeCursor:
+    # Answers the queries oracleToXLSX sends from the bind values alone.
+    # Rows a real server would have to read and throw away (OFFSET, or rows
+    # outside a hash bucket) are generated and dropped so they cost time too.
+    def __init__(self, row_count):
+        self.row_count = row_count
+        self.arraysize = 100
+        self.prefetchrows = 2
+        self.outputtypehandler = None
+        self.description = DESCRIPTION
+        self.rows = iter(())
+
+    def execute(self, query, params=None):
+        statement = query.upper()
+        if 'COUNT(*)' in statement:
+            # A real count reads every row
+            for row_id in range(self.row_count):
+                make_row(row_id)
+            self.rows = iter([(self.row_count,)])
+        elif 'MIN(' in statement:
+            self.rows = iter([(0, self.row_count - 1)])
+        elif statement.startswith(('EXPLAIN', 'DELETE')):
+            self.rows = iter(())
+        elif 'CARDINALITY' in statement or 'NUM_ROWS' in statement:
+            # Plan estimates and table statistics cost next to nothing
+            self.rows = iter([(self.row_count,)])
+        else:
+            self.rows = self.generate_rows(query, params or {})
+
+    def generate_rows(self, query, params):
+        start, stop = 0, self.row_count
+
+        if 'last_key' in params:
+            start = params['last_key'] + 1
+        if 'low' in params:
+            # Key range partitions, the last one includes its upper bound
+            start = max(start, math.ceil(params['low']))
+            if '<= :HIGH' in query.upper():
+                stop = min(stop, math.floor(params['high']) + 1)
+            else:
+                stop = min(stop, math.ceil(params['high']))
+
+        if 'offset_rows' in params:
+            for row_id in range(start, min(start + params['offset_rows'], stop)):
+                make_row(row_id)
+            start += params['offset_rows']
+        if 'chunk_size' in params:
+            stop = min(stop, start + params['chunk_size'])
+
+        for row_id in range(start, stop):
+            row = make_row(row_id)
+            if 'bucket' in params and row_id % (params['buckets'] + 1) != params['bucket']:
+                continue
+            yield row
+
+    def fetchmany(self, size=None):
+        rows = []
+        for row in self.rows:
+            rows.append(row)
+            if len(rows) >= (size or self.arraysize):
+                break
+        return rows
+
+    def fetchone(self):
+        return next(self.rows, None)
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, row_count):
+        self.row_count = row_count
+
+    def cursor(self):
+        return FakeCursor(self.row_count)
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class FakePool:
+    def __init__(self, row_count):
+        self.row_count = row_count
+
+    def acquire(self):
+        return FakeConnection(self.row_count)
+
+
+def peak_memory_mb():
+    # Peak resident memory of this process so far
+    try:
+        import resource
+    except ImportError:
+        # Windows: ask the process for its peak working set
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [('cb', wintypes.DWORD), ('PageFaultCount', wintypes.DWORD),
+                        ('PeakWorkingSetSize', ctypes.c_size_t),
+                        ('WorkingSetSize', ctypes.c_size_t),
+                        ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                        ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                        ('PagefileUsage', ctypes.c_size_t),
+                        ('PeakPagefileUsage', ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize / 1024 / 1024
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def timed_chunks(data_chunks, timings):
+    # Pass the chunks through, adding the time spent producing them to 'fetch'
+    while True:
+        start_time = time.perf_counter()
+        try:
+            chunk_df = next(data_chunks)
+        except StopIteration:
+            timings['fetch'] += time.perf_counter() - start_time
+            return
+        timings['fetch'] += time.perf_counter() - start_time
+        timings['chunks'] += 1
+        yield chunk_df
+
+
+def run_case(case, row_count, chunk_size, output_folder, results):
+    # Run one case in this (fresh) process and put its measurements on results
+    export.load_dependencies()
+    pool = FakePool(row_count)
+    query = 'SELECT * FROM benchmark_rows'
+    timings = {'count': 0.0, 'fetch': 0.0, 'frame': 0.0, 'write': 0.0, 'chunks': 0}
+
+    # Time spent building DataFrames, counted inside the fetch time
+    rows_to_frame = export.rows_to_frame
+
+    def timed_rows_to_frame(*args):
+        start_time = time.perf_counter()
+        chunk_df = rows_to_frame(*args)
+        timings['frame'] += time.perf_counter() - start_time
+        return chunk_df
+
+    export.rows_to_frame = timed_rows_to_frame
+
+    if case == 'count':
+        start_time = time.perf_counter()
+        export.get_total_rows(query, pool, 'count')
+        timings['count'] = time.perf_counter() - start_time
+        data_chunks = iter(())
+    elif case == 'offset':
+        data_chunks = export.fetch_data_in_chunks(query, pool, chunk_size, 'offset')
+    elif case == 'keyset':
+        data_chunks = export.fetch_data_in_chunks(query, pool, chunk_size, 'keyset', 'ID')
+    elif case in ('hash4', 'range4'):
+        method = 'hash' if case == 'hash4' else 'range'
+        partitions = export.get_partitions(query, pool, 4, method, 'ID')
+        data_chunks = export.fetch_partitions(
+            query, pool, partitions, chunk_size, chunk_size, chunk_size)
+    else:
+        data_chunks = export.stream_data(
+            query, pool, chunk_size, export.ARRAYSIZE, export.PREFETCH_ROWS)
+
+    data_chunks = timed_chunks(iter(data_chunks), timings)
+    start_time = time.perf_counter()
+
+    if case in WRITE_CASES:
+        output_format = 'xlsx' if case.startswith('xlsx') else case
+        writer = 'pandas' if case == 'xlsx-pandas' else 'streaming'
+        output_filepath = os.path.join(output_folder, f'benchmark.{output_format}')
+        files_written = export.write_data(
+            data_chunks, output_filepath, output_format, {'query': query}, writer)
+        file_size = sum(os.path.getsize(path) for path in files_written)
+        timings['write'] = time.perf_counter() - start_time - timings['fetch']
+    else:
+        for _ in data_chunks:
+            pass
+        file_size = 0
+
+    results.put({
+        'case': case,
+        'rows': row_count,
+        'chunk_size': chunk_size,
+        'count_s': round(timings['count'], 3),
+        'fetch_s': round(timings['fetch'], 3),
+        'frame_s': round(timings['frame'], 3),
+        'write_s': round(timings['write'], 3),
+        'total_s': round(timings['count'] + timings['fetch'] + timings['write'], 3),
+        'chunks': timings['chunks'],
+        'file_mb': round(file_size / 1024 / 1024, 2),
+        'peak_mb': round(peak_memory_mb(), 1)
+    })
+
+
+def run_in_process(case, row_count, chunk_size, output_folder):
+    # A new process per case so the peak memory belongs to that case alone
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    process = context.Process(
+        target=run_case, args=(case, row_count, chunk_size, output_folder, results))
+    process.start()
+    process.join()
+
+    if process.exitcode != 0:
+        return {'case': case, 'rows': row_count, 'chunk_size': chunk_size, 'error': process.exitcode}
+
+    result = results.get()
+    total_s = result['total_s'] - result['count_s']
+    result['rows_per_s'] = round(row_count / total_s) if total_s else None
+    return result
+
+
+def print_result(result):
+    if 'error' in result:
+        print(f"{result['case']:<12} {result['rows']:>11,} {result['chunk_size']:>7,}  "
+              f"failed with exit code {result['error']}")
+        return
+
+    rows_per_s = f"{result['rows_per_s']:,}" if result.get('rows_per_s') else '-'
+    print(f"{result['case']:<12} {result['rows']:>11,} {result['chunk_size']:>7,} "
+          f"{result['count_s']:>8.2f} {result['fetch_s']:>8.2f} {result['frame_s']:>8.2f} "
+          f"{result['write_s']:>8.2f} {rows_per_s:>11} {result['file_mb']:>8.1f} "
+          f"{result['peak_mb']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the oracleToXLSX pipeline against a stand-in database.')
+    parser.add_argument('--rows', type=int, nargs='+', default=ROW_COUNTS,
+                        help='row counts to run each case with')
+    parser.add_argument('--chunk-size', type=int, nargs='+', default=[export.CHUNK_SIZE],
+                        help='CHUNK_SIZE values to compare')
+    parser.add_argument('--cases', nargs='+', choices=['count'] + FETCH_CASES + WRITE_CASES,
+                        help=f'cases to run (default: all, without {" and ".join(SMALL_CASES)} '
+                             f'above {LARGE_ROWS:,} rows)')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also append the results to FILE as JSON lines')
+    args = parser.parse_args()
+
+    print(f"{'Case':<12} {'Rows':>11} {'Chunk':>7} {'Count s':>8} {'Fetch s':>8} "
+          f"{'Frame s':>8} {'Write s':>8} {'Rows/s':>11} {'File MB':>8} {'Peak MB':>8}")
+
+    with tempfile.TemporaryDirectory() as output_folder:
+        for row_count in args.rows:
+            for chunk_size in args.chunk_size:
+                for case in args.cases or ['count'] + FETCH_CASES + WRITE_CASES:
+                    if not args.cases and case in SMALL_CASES and row_count > LARGE_ROWS:
+                        continue
+                    result = run_in_process(case, row_count, chunk_size, output_folder)
+                    print_result(result)
+
+                    if args.json:
+                        result['run_at'] = datetime.now().isoformat(timespec='seconds')
+                        with open(args.json, 'a') as json_file:
+                            json_file.write(json.dumps(result) + '\n')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,20 @@
+import argparse
+import gzip
+import hashlib
+import importlib.util
+import itertools
+import json
 import os
+import queue
+import random
+import re
+import shutil
+import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-
-try:
-    import oracledb
-    import pandas as pd
-    from sqlalchemy import create_engine, text
-    from tqdm import tqdm
-except ImportError as e:
-    missing_package = str(e).split()[-1]
-    print(f"Missing required package: {missing_package}.")
-    print(f"pip install {missing_package}")
-    exit(1)
+from decimal import Decimal
 
 DATABASE = 'DEV'
 OUTPUT_FILENAME = 'filename_goes_here'
@@ -22,6 +25,99 @@ QUERY = '''
  
 '''
 
+# Values for the :name bind variables in QUERY, e.g. {'site': 'NORTH'} for
+# WHERE site = :site. Binding instead of pasting values into the query text
+# lets Oracle reuse one parsed statement for every run and chunk. Dates can
+# be passed as 'YYYY-MM-DD' strings and read with TO_DATE(:name, 'YYYY-MM-DD').
+BINDS = {}
+
+# How chunks are paged:
+#   'offset' - OFFSET n ROWS FETCH NEXT m ROWS ONLY (slows down as n grows)
+#   'keyset' - resume after the last PAGINATION_KEY value seen; the key must
+#              be a unique, non-null column in the select list
+#   'rowid'  - same as keyset, but PAGINATION_KEY is a ROWID selected in the
+#              query, e.g. SELECT t.ROWID AS ROW_ID, t.* FROM table t
+# Falls back to 'offset' when PAGINATION_KEY is not set
+PAGINATION = 'offset'
+PAGINATION_KEY = None
+
+# How rows are fetched:
+#   'chunked' - one query per chunk, paged as set by PAGINATION
+#   'stream'  - run the query once and read CHUNK_SIZE rows at a time from a
+#               single cursor
+FETCH_MODE = 'chunked'
+# Rows per network round trip and rows sent back with the execute call
+ARRAYSIZE = 5000
+PREFETCH_ROWS = 5000
+
+# How the workbook is written:
+#   'streaming' - append each chunk to a write-only workbook as it arrives,
+#                 memory stays around one chunk
+#   'pandas'    - collect everything into one DataFrame, then df.to_excel
+WRITER = 'streaming'
+
+# The streaming writer moves on to Data_2, Data_3, ... when a sheet reaches
+# MAX_ROWS_PER_SHEET, and to a new workbook (name_2.xlsx, ...) after
+# MAX_SHEETS_PER_WORKBOOK sheets. None keeps every sheet in one workbook.
+# Excel allows 1,048,576 rows per sheet, one of them is the header.
+MAX_ROWS_PER_SHEET = 1048575
+MAX_SHEETS_PER_WORKBOOK = None
+
+# Output file format: 'xlsx', 'parquet', 'feather' or 'csv.gz'
+# parquet and feather need pyarrow and keep the query in the file metadata,
+# csv.gz writes it to a .json file next to the export
+OUTPUT_FORMAT = 'xlsx'
+
+# Split the query into PARALLEL_PARTITIONS disjoint parts, each fetched on
+# its own connection at the same time. 1 fetches on a single connection.
+#   'hash'  - ORA_HASH buckets of PARTITION_KEY, works with any column
+#   'range' - equal slices between the MIN and MAX of a numeric PARTITION_KEY
+#   'rowid' - ROWID ranges from the extents of PARTITION_TABLE ('OWNER.TABLE',
+#             partitioned or not),
+#             PARTITION_KEY is a ROWID selected in the query (as for
+#             PAGINATION = 'rowid'); needs SELECT access to DBA_EXTENTS
+PARALLEL_PARTITIONS = 1
+PARTITION_METHOD = 'hash'
+PARTITION_KEY = None
+PARTITION_TABLE = None
+# 'merge' writes the partitions to one export in partition order (partitions
+# that finish early are held in memory until their turn), 'parts' writes each
+# partition to its own file
+PARALLEL_OUTPUT = 'merge'
+
+# Where the progress bar gets its total from:
+#   'none'     - no total, just rows/sec and bytes/sec
+#   'estimate' - the optimizer's row estimate from EXPLAIN PLAN
+#   'stats'    - num_rows from the statistics of PROGRESS_TABLE ('OWNER.TABLE')
+#   'count'    - run a COUNT(*) of the query first (exact, but scans twice)
+PROGRESS_TOTAL = 'estimate'
+PROGRESS_TABLE = None
+
+# Fetched results are kept in exports/.cache and reused when the same query
+# is exported from the same database again within CACHE_TTL_HOURS. The least
+# recently used results are removed once the cache grows past CACHE_MAX_MB.
+# Run with --refresh to fetch from Oracle regardless. Needs pyarrow.
+USE_CACHE = True
+CACHE_TTL_HOURS = 24
+CACHE_MAX_MB = 2048
+
+# Delta exports: set WATERMARK_COLUMN to a timestamp or sequence column in the
+# select list and each run only fetches rows past the highest value exported
+# by the previous run of this OUTPUT_FILENAME/DATABASE (kept in
+# exports/.watermarks.json). The first run exports everything.
+# csv.gz exports get the new rows appended to the previous file. For other
+# formats, 'merge' rewrites the previous export with the new rows added and
+# removes the old file, 'separate' writes just the new rows to a new file.
+WATERMARK_COLUMN = None
+DELTA_OUTPUT = 'merge'
+
+# Write the time spent connecting, counting, fetching, building DataFrames
+# and writing each chunk to a JSON-lines .runlog.jsonl file next to the export
+RUN_LOG = True
+
+# Parsed statements each pooled connection keeps ready to execute again
+STATEMENT_CACHE_SIZE = 50
+
 # Shouldn't need to edit this unless the databases change
 DATABASES = {
     'CREDENTIALS': {
@@ -45,93 +141,1531 @@ DATABASES = {
     }
 }
 
-# Generate DSN Connection info
-dsn_tns = oracledb.makedsn(
-    host=DATABASES[DATABASE]['hostname'],
-    port=DATABASES[DATABASE]['port'],
-    service_name=DATABASES[DATABASE]['service']
-)
+# Settings a job file entry can set, by their lowercase names. Anything a
+# job leaves out comes from the values above.
+JOB_SETTINGS = [
+    'DATABASE', 'OUTPUT_FILENAME', 'QUERY', 'BINDS', 'CHUNK_SIZE', 'PAGINATION',
+    'PAGINATION_KEY', 'FETCH_MODE', 'ARRAYSIZE', 'PREFETCH_ROWS', 'WRITER',
+    'MAX_ROWS_PER_SHEET', 'MAX_SHEETS_PER_WORKBOOK', 'OUTPUT_FORMAT',
+    'PARALLEL_PARTITIONS', 'PARTITION_METHOD', 'PARTITION_KEY', 'PARTITION_TABLE',
+    'PARALLEL_OUTPUT', 'PROGRESS_TOTAL', 'PROGRESS_TABLE', 'USE_CACHE',
+    'CACHE_TTL_HOURS', 'CACHE_MAX_MB', 'WATERMARK_COLUMN', 'DELTA_OUTPUT', 'RUN_LOG'
+]
+
+# How many jobs from a job file run at the same time
+JOB_WORKERS = 2
+
+# How many fetched chunks each partition may hold while it waits for the
+# writer to reach it, with PARALLEL_OUTPUT = 'merge'
+PARTITION_QUEUE_CHUNKS = 2
+
+# Values per text column sized to estimate the bytes/sec shown while fetching
+FRAME_BYTES_SAMPLE = 100
+
+# One connection pool per DATABASES entry, shared by every job that uses it
+pools = {}
+pools_lock = threading.Lock()
 
 
-# Create SQLAlchemy engine
-engine = create_engine(
-    f'oracle+oracledb://{DATABASES["CREDENTIALS"]["username"]}:{DATABASES["CREDENTIALS"]["password"]}@{dsn_tns}')
+def load_dependencies():
+    # The heavy packages are only imported once there is data to move, so
+    # --help, --dry-run and the settings checks start straight away
+    global oracledb, pd, Workbook, load_workbook, tqdm
+
+    try:
+        import oracledb
+        import pandas as pd
+        from openpyxl import Workbook, load_workbook
+        from tqdm import tqdm
+    except ImportError as e:
+        missing_package = str(e).split()[-1]
+        print(f"Missing required package: {missing_package}.")
+        print(f"pip install {missing_package}")
+        exit(1)
+
+
+def get_pool(database, pool_size=5):
+    # Create the pool for a DATABASES entry the first time it is needed,
+    # using the oracledb thin driver directly
+    with pools_lock:
+        if database not in pools:
+            # Generate DSN Connection info
+            dsn_tns = oracledb.makedsn(
+                host=DATABASES[database]['hostname'],
+                port=DATABASES[database]['port'],
+                service_name=DATABASES[database]['service']
+            )
+
+            pools[database] = oracledb.create_pool(
+                user=DATABASES['CREDENTIALS']['username'],
+                password=DATABASES['CREDENTIALS']['password'],
+                dsn=dsn_tns, min=1, max=max(5, pool_size), increment=1,
+                stmtcachesize=STATEMENT_CACHE_SIZE)
+
+        return pools[database]
+
+
+def log_stage(run_log, stage, start_time, **fields):
+    # Record how long a stage took since start_time, if a run log is being kept
+    if run_log is not None:
+        run_log.append({
+            'stage': stage,
+            'seconds': round(time.perf_counter() - start_time, 6),
+            'thread': threading.current_thread().name,
+            **fields
+        })
+
+
+def write_run_log(run_log, run_log_filepath, run_fields):
+    # One JSON object per line, each with the details of the run it belongs to
+    with open(run_log_filepath, 'a') as run_log_file:
+        for record in run_log:
+            run_log_file.write(json.dumps({**run_fields, **record}, default=str) + '\n')
 
 
 def generate_count_query(original_query):
-    # Generate a count query from the original query
-    upper_query = original_query.upper()
-    from_pos = upper_query.find('FROM')
+    # Count the rows of the whole query, whatever its select list or ORDER BY
+    base_query = original_query.strip().rstrip(';')
+    return f"SELECT COUNT(*) FROM ({base_query}) count_query"
+
+
+def generate_explain_query(original_query, statement_id):
+    # Ask the optimizer for its plan, the row estimate ends up in PLAN_TABLE
+    base_query = original_query.strip().rstrip(';')
+    return f"EXPLAIN PLAN SET STATEMENT_ID = '{statement_id}' FOR {base_query}"
+
+
+def get_total_rows(query, pool, source, table_name=None, binds=None, run_log=None):
+    # Rows to expect for the progress bar, from the cheapest source asked for
+    if source == 'none':
+        return None
+
+    start_time = time.perf_counter()
+    total_rows = lookup_total_rows(query, pool, source, table_name, binds)
+    log_stage(run_log, 'count', start_time, source=source, rows=total_rows)
+    return total_rows
+
+
+def lookup_total_rows(query, pool, source, table_name=None, binds=None):
+    try:
+        with pool.acquire() as connection:
+            cursor = connection.cursor()
+
+            if source == 'count':
+                cursor.execute(generate_count_query(query), binds or {})
+                return cursor.fetchone()[0]
+
+            if source == 'stats':
+                if not table_name:
+                    raise ValueError("Table statistics need a PROGRESS_TABLE")
+                owner, _, table = table_name.upper().rpartition('.')
+                cursor.execute(
+                    "SELECT num_rows FROM all_tables "
+                    "WHERE owner = NVL(:owner, USER) AND table_name = :table_name",
+                    {'owner': owner or None, 'table_name': table})
+                row = cursor.fetchone()
+                if row is None:
+                    print(f"Table {table_name} not found in ALL_TABLES, progress will not show a row total")
+                    return None
+                return row[0]
+
+            if source == 'estimate':
+                statement_id = f'oracleToXLSX_{os.getpid()}_{threading.get_ident() % 10000}'
+                cursor.execute(generate_explain_query(query, statement_id), binds or {})
+                cursor.execute(
+                    "SELECT cardinality FROM plan_table "
+                    "WHERE statement_id = :statement_id AND id = 0",
+                    {'statement_id': statement_id})
+                row = cursor.fetchone()
+                cursor.execute(
+                    "DELETE FROM plan_table WHERE statement_id = :statement_id",
+                    {'statement_id': statement_id})
+                connection.commit()
+                if row is None:
+                    print("No plan estimate found in PLAN_TABLE, progress will not show a row total")
+                    return None
+                return row[0]
+    except oracledb.Error as e:
+        print(f"Could not get the {source} row total, progress will not show one: {e}")
+        return None
+
+    raise ValueError(f"Unknown progress total '{source}'")
+
+
+def progress_bar(total_rows=None, desc='Fetching data'):
+    # Progress in rows/sec, with bytes/sec shown alongside
+    return tqdm(total=total_rows, desc=desc, unit=' rows', unit_scale=True)
+
+
+def update_progress(pbar, chunk_df, totals):
+    # Count the chunk on the bar and refresh the bytes/sec fetched so far
+    totals['rows'] += len(chunk_df)
+    totals['bytes'] += frame_bytes(chunk_df)
+    pbar.update(len(chunk_df))
+
+    elapsed = pbar.format_dict['elapsed']
+    if elapsed:
+        pbar.set_postfix_str(
+            f"{tqdm.format_sizeof(totals['bytes'] / elapsed, 'B')}/s")
+
+
+def track_progress(data_chunks, total_rows=None, desc='Fetching data', totals=None):
+    # Pass the chunks through while showing progress, counting into totals
+    if totals is None:
+        totals = {'rows': 0, 'bytes': 0}
+
+    with progress_bar(total_rows, desc) as pbar:
+        for chunk_df in data_chunks:
+            yield chunk_df
+            update_progress(pbar, chunk_df, totals)
+
+
+def generate_offset_query(original_query):
+    # Page through the query as written, skipping the rows already fetched
+    return f"{original_query} OFFSET :offset_rows ROWS FETCH NEXT :chunk_size ROWS ONLY"
+
+
+def generate_keyset_query(original_query, key_column, pagination, first_chunk):
+    # Page through the query ordered by the key, starting after the last key seen
+    base_query = original_query.strip().rstrip(';')
+
+    if first_chunk:
+        condition = f"{key_column} IS NOT NULL"
+    elif pagination == 'rowid':
+        condition = f"{key_column} > CHARTOROWID(:last_key)"
+    else:
+        condition = f"{key_column} > :last_key"
+
+    return (f"SELECT * FROM ({base_query}) keyset_query "
+            f"WHERE {condition} ORDER BY {key_column} "
+            f"FETCH FIRST :chunk_size ROWS ONLY")
+
+
+def find_column(chunk_df, column_name):
+    # Column names may come back in a different case than they were written
+    for column in chunk_df.columns:
+        if column.upper() == column_name.upper():
+            return column
+
+    raise ValueError(f"Column '{column_name}' is not in the query results")
+
+
+def to_bind_value(value):
+    # Convert numpy/pandas scalars to plain Python values for binding
+    if hasattr(value, 'to_pydatetime'):
+        return value.to_pydatetime()
+    if hasattr(value, 'item'):
+        return value.item()
+    return value
+
+
+def get_last_key(chunk_df, key_column):
+    # The pagination key of the last row in the chunk
+    return to_bind_value(chunk_df[find_column(chunk_df, key_column)].iloc[-1])
+
+
+def whole_or_float(value):
+    # Unconstrained NUMBER values keep whole numbers exact
+    if value is None:
+        return None
+    return int(value) if value == value.to_integral_value() else float(value)
+
+
+def output_type_handler(cursor, metadata):
+    # Have the driver return numbers as int/float and LOBs as str/bytes
+    # instead of Decimal and per-row LOB objects
+    if metadata.type_code is oracledb.DB_TYPE_NUMBER:
+        if metadata.scale == 0:
+            return cursor.var(int, arraysize=cursor.arraysize)
+        if is_unconstrained_number(metadata.scale):
+            return cursor.var(Decimal, arraysize=cursor.arraysize, outconverter=whole_or_float)
+        return cursor.var(float, arraysize=cursor.arraysize)
+
+    if metadata.type_code in (oracledb.DB_TYPE_CLOB, oracledb.DB_TYPE_NCLOB):
+        return cursor.var(oracledb.DB_TYPE_LONG, arraysize=cursor.arraysize)
+
+    if metadata.type_code is oracledb.DB_TYPE_BLOB:
+        return cursor.var(oracledb.DB_TYPE_LONG_RAW, arraysize=cursor.arraysize)
+
+
+def is_integer_column(precision, scale):
+    # NUMBER(p, 0) fits in 64 bits up to 18 digits
+    return scale == 0 and 0 < (precision or 0) <= 18
+
+
+def is_unconstrained_number(scale):
+    # NUMBER and FLOAT columns without a scale (including COUNT(*), SUM and
+    # other expressions) are described with a scale of -127
+    return scale == -127
+
+
+def get_column_dtypes(description):
+    # One fixed dtype per column, worked out from the cursor description once.
+    # Whole numbers too big for Int64 and unconstrained NUMBERs (whole numbers
+    # as int, the rest as float) are kept as Python objects so none lose digits.
+    # Timestamps with a time zone come back from the driver without it.
+    datetime_types = (oracledb.DB_TYPE_DATE, oracledb.DB_TYPE_TIMESTAMP,
+                      oracledb.DB_TYPE_TIMESTAMP_TZ, oracledb.DB_TYPE_TIMESTAMP_LTZ)
+    dtypes = []
+
+    for _, type_code, _, _, precision, scale, _ in description:
+        if type_code is oracledb.DB_TYPE_NUMBER:
+            if is_integer_column(precision, scale):
+                dtypes.append('Int64')
+            elif scale == 0 or is_unconstrained_number(scale):
+                dtypes.append(object)
+            else:
+                dtypes.append('float64')
+        elif type_code in (oracledb.DB_TYPE_BINARY_FLOAT, oracledb.DB_TYPE_BINARY_DOUBLE):
+            dtypes.append('float64')
+        elif type_code in datetime_types:
+            dtypes.append('datetime64[us]')
+        elif type_code is oracledb.DB_TYPE_INTERVAL_DS:
+            dtypes.append('timedelta64[us]')
+        else:
+            dtypes.append(object)
+
+    return dtypes
+
+
+def get_arrow_kinds(description):
+    # The Arrow type of each object column, by name, so a column that is all
+    # NULL in the first chunk still gets the right one:
+    #   'string'    - character, LOB and ROWID columns
+    #   'binary'    - RAW, LONG RAW and BLOB
+    #   'bool'      - BOOLEAN
+    #   'decimal:p' - NUMBER(p, 0) too big for int64, kept exact as decimal(p, 0)
+    #   'number'    - unconstrained NUMBER, mixing ints and floats, stored as double
+    # Columns with a fixed dtype (see get_column_dtypes) already show their type.
+    text_types = (oracledb.DB_TYPE_VARCHAR, oracledb.DB_TYPE_NVARCHAR, oracledb.DB_TYPE_CHAR,
+                  oracledb.DB_TYPE_NCHAR, oracledb.DB_TYPE_LONG, oracledb.DB_TYPE_LONG_NVARCHAR,
+                  oracledb.DB_TYPE_CLOB, oracledb.DB_TYPE_NCLOB, oracledb.DB_TYPE_ROWID,
+                  oracledb.DB_TYPE_UROWID)
+    binary_types = (oracledb.DB_TYPE_RAW, oracledb.DB_TYPE_LONG_RAW, oracledb.DB_TYPE_BLOB)
+    arrow_kinds = {}
+
+    for name, type_code, _, _, precision, scale, _ in description:
+        if type_code in text_types:
+            arrow_kinds[name] = 'string'
+        elif type_code in binary_types:
+            arrow_kinds[name] = 'binary'
+        elif type_code is oracledb.DB_TYPE_BOOLEAN:
+            arrow_kinds[name] = 'bool'
+        elif type_code is oracledb.DB_TYPE_NUMBER and scale == 0 \
+                and not is_integer_column(precision, scale):
+            arrow_kinds[name] = f'decimal:{precision or 38}'
+        elif type_code is oracledb.DB_TYPE_NUMBER and is_unconstrained_number(scale):
+            arrow_kinds[name] = 'number'
+
+    return arrow_kinds
+
+
+def open_cursor(connection, arraysize, prefetch_rows):
+    # A cursor set up for bulk fetches with typed output
+    cursor = connection.cursor()
+    cursor.arraysize = arraysize
+    cursor.prefetchrows = prefetch_rows
+    cursor.outputtypehandler = output_type_handler
+    return cursor
+
+
+def rows_to_frame(rows, columns, dtypes, run_log=None, arrow_kinds=None):
+    # Build the frame column by column so every chunk gets the same dtypes
+    start_time = time.perf_counter()
+    column_values = list(zip(*rows)) if rows else [()] * len(columns)
+    chunk_df = pd.DataFrame({
+        position: pd.Series(values, dtype=dtype)
+        for position, (values, dtype) in enumerate(zip(column_values, dtypes))
+    })
+    chunk_df.columns = columns
+    chunk_df.attrs['arrow_kinds'] = dict(arrow_kinds or {})
+
+    if run_log is not None:
+        log_stage(run_log, 'frame', start_time, rows=len(chunk_df),
+                  bytes=frame_bytes(chunk_df))
+    return chunk_df
+
+
+def frame_bytes(chunk_df):
+    # Estimated in-memory size of a chunk, worked out once and kept with it.
+    # Typed columns are measured exactly; object columns (text, bytes, big
+    # numbers) from the size of FRAME_BYTES_SAMPLE values picked at random, since
+    # measuring every value costs about as much as writing the chunk.
+    if 'bytes' not in chunk_df.attrs:
+        size = int(chunk_df.memory_usage(index=False).sum())
+        rows = len(chunk_df)
+        picks = random.Random(rows).sample(range(rows), min(rows, FRAME_BYTES_SAMPLE))
+        for position, dtype in enumerate(chunk_df.dtypes):
+            if dtype == object and picks:
+                values = chunk_df.iloc[:, position].array
+                size += sum(sys.getsizeof(values[row]) for row in picks) * rows // len(picks)
+        chunk_df.attrs['bytes'] = size
+    return chunk_df.attrs['bytes']
+
+
+def fetch_data_in_chunks(query, pool, chunk_size, pagination='offset', key_column=None,
+                         binds=None, run_log=None):
+    # Execute query in chunks and yield each chunk as it arrives
+    if pagination not in ('offset', 'keyset', 'rowid'):
+        raise ValueError(f"Unknown pagination mode '{pagination}'")
+
+    if pagination != 'offset' and not key_column:
+        print("No pagination key set, falling back to offset pagination.")
+        pagination = 'offset'
+
+    if pagination == 'offset':
+        first_query = next_query = generate_offset_query(query)
+    else:
+        first_query = generate_keyset_query(
+            query, key_column, pagination, first_chunk=True)
+        next_query = generate_keyset_query(
+            query, key_column, pagination, first_chunk=False)
+
+    start_time = time.perf_counter()
+    connection = pool.acquire()
+    log_stage(run_log, 'connect', start_time)
+
+    try:
+        # Each chunk comes back in one round trip
+        cursor = open_cursor(connection, chunk_size, chunk_size + 1)
+        params = {**(binds or {}), 'chunk_size': chunk_size}
+        if pagination == 'offset':
+            params['offset_rows'] = 0
+        chunk_query = first_query
+        columns = dtypes = arrow_kinds = None
+
+        while True:
+            start_time = time.perf_counter()
+            cursor.execute(chunk_query, params)
+            if columns is None:
+                columns = [column[0] for column in cursor.description]
+                dtypes = get_column_dtypes(cursor.description)
+                arrow_kinds = get_arrow_kinds(cursor.description)
+
+            rows = cursor.fetchall()
+            log_stage(run_log, 'fetch', start_time, rows=len(rows))
+            if not rows:
+                break
+
+            chunk_df = rows_to_frame(rows, columns, dtypes, run_log, arrow_kinds)
+            yield chunk_df
+
+            # A short chunk means there is nothing left to fetch
+            if len(chunk_df) < chunk_size:
+                break
+
+            if pagination == 'offset':
+                params['offset_rows'] += chunk_size
+            else:
+                params['last_key'] = get_last_key(chunk_df, key_column)
+            chunk_query = next_query
+
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def read_cursor_batches(pool, query, params, chunk_size, arraysize, prefetch_rows,
+                        run_log=None):
+    # Execute query once and yield batches read from one cursor
+    start_time = time.perf_counter()
+    connection = pool.acquire()
+    log_stage(run_log, 'connect', start_time)
+
+    try:
+        start_time = time.perf_counter()
+        cursor = open_cursor(connection, arraysize, prefetch_rows)
+        cursor.execute(query.strip().rstrip(';'), params or {})
+        columns = [column[0] for column in cursor.description]
+        dtypes = get_column_dtypes(cursor.description)
+        arrow_kinds = get_arrow_kinds(cursor.description)
+        log_stage(run_log, 'execute', start_time)
+
+        while True:
+            start_time = time.perf_counter()
+            rows = cursor.fetchmany(chunk_size)
+            log_stage(run_log, 'fetch', start_time, rows=len(rows))
+            if not rows:
+                break
+
+            yield rows_to_frame(rows, columns, dtypes, run_log, arrow_kinds)
+
+        cursor.close()
+    finally:
+        connection.close()
+
+
+def stream_data(query, pool, chunk_size, arraysize, prefetch_rows, binds=None,
+                run_log=None):
+    # Stream the whole query through one cursor
+    return read_cursor_batches(pool, query, binds, chunk_size, arraysize, prefetch_rows,
+                               run_log)
+
+
+# Splits a table's extents into groups of roughly equal size, then turns the
+# first and last block of each group into a ROWID range. The extents of a
+# partitioned table belong to one segment per (sub)partition, each with its
+# own data object id, so a group that spans segments gets one range for each.
+ROWID_RANGE_QUERY = '''
+SELECT g.grp,
+       DBMS_ROWID.ROWID_CREATE(1, g.data_object_id, g.low_file, g.low_block, 0),
+       DBMS_ROWID.ROWID_CREATE(1, g.data_object_id, g.high_file, g.high_block, 32767)
+FROM (
+    SELECT grp, data_object_id,
+           MIN(relative_fno) KEEP (DENSE_RANK FIRST ORDER BY relative_fno, block_id) AS low_file,
+           MIN(block_id) KEEP (DENSE_RANK FIRST ORDER BY relative_fno, block_id) AS low_block,
+           MAX(relative_fno) KEEP (DENSE_RANK LAST ORDER BY relative_fno, block_id) AS high_file,
+           MAX(block_id + blocks - 1) KEEP (DENSE_RANK LAST ORDER BY relative_fno, block_id) AS high_block
+    FROM (
+        SELECT o.data_object_id, e.relative_fno, e.block_id, e.blocks,
+               TRUNC((SUM(e.blocks) OVER (ORDER BY o.data_object_id, e.relative_fno, e.block_id) - 0.01)
+                     / (SUM(e.blocks) OVER () / :partitions)) AS grp
+        FROM dba_extents e
+        JOIN all_objects o
+          ON o.owner = e.owner
+         AND o.object_name = e.segment_name
+         AND o.object_type = e.segment_type
+         AND DECODE(o.subobject_name, e.partition_name, 1, 0) = 1
+        WHERE e.owner = NVL(:owner, USER)
+          AND e.segment_name = :table_name
+          AND e.segment_type IN ('TABLE', 'TABLE PARTITION', 'TABLE SUBPARTITION')
+    )
+    GROUP BY grp, data_object_id
+) g
+ORDER BY g.grp, g.data_object_id
+'''
+
+
+def get_partitions(query, pool, partition_count, method, key_column, table_name=None,
+                   binds=None):
+    # Work out the filter and bind values that select each partition
+    base_query = query.strip().rstrip(';')
+
+    if not key_column:
+        raise ValueError("Parallel extraction needs a PARTITION_KEY")
+
+    # Rows with a NULL key hash and compare to nothing, so the first
+    # partition takes them as well
+    if method == 'hash':
+        return [(f"(ORA_HASH({key_column}, :buckets) = :bucket OR {key_column} IS NULL)"
+                 if bucket == 0 else f"ORA_HASH({key_column}, :buckets) = :bucket",
+                 {'buckets': partition_count - 1, 'bucket': bucket})
+                for bucket in range(partition_count)]
+
+    if method == 'range':
+        with pool.acquire() as connection:
+            cursor = connection.cursor()
+            cursor.execute(
+                f"SELECT MIN({key_column}), MAX({key_column}) "
+                f"FROM ({base_query}) range_query", binds or {})
+            low, high = cursor.fetchone()
+
+        if low is None:
+            return [(f"{key_column} IS NULL", {})]
+
+        step = (high - low) / partition_count
+        bounds = [low + step * i for i in range(partition_count)] + [high]
+        partitions = []
+        for i in range(partition_count):
+            # The last slice includes the maximum itself
+            operator = '<=' if i == partition_count - 1 else '<'
+            condition = f"{key_column} >= :low AND {key_column} {operator} :high"
+            if i == 0:
+                condition = f"({condition} OR {key_column} IS NULL)"
+            partitions.append((condition, {'low': bounds[i], 'high': bounds[i + 1]}))
+        return partitions
+
+    if method == 'rowid':
+        if not table_name:
+            raise ValueError("ROWID partitions need a PARTITION_TABLE")
+
+        owner, _, table = table_name.upper().rpartition('.')
+        with pool.acquire() as connection:
+            cursor = connection.cursor()
+            cursor.execute(ROWID_RANGE_QUERY, {
+                'owner': owner or None,
+                'table_name': table,
+                'partitions': partition_count
+            })
+            ranges = cursor.fetchall()
+
+        if not ranges:
+            raise ValueError(
+                f"No extents found for PARTITION_TABLE {table_name}. Check the name, that "
+                f"the table has rows and that you can SELECT from DBA_EXTENTS, or use "
+                f"PARTITION_METHOD 'hash'.")
+
+        # One partition per group, covering each of its segments' ROWID ranges
+        partitions = []
+        for _, group_ranges in itertools.groupby(ranges, key=lambda row: row[0]):
+            conditions = []
+            params = {}
+            for i, (_, low, high) in enumerate(group_ranges):
+                conditions.append(
+                    f"{key_column} BETWEEN CHARTOROWID(:low{i}) AND CHARTOROWID(:high{i})")
+                params.update({f'low{i}': low, f'high{i}': high})
+            partitions.append((f"({' OR '.join(conditions)})", params))
+        return partitions
+
+    raise ValueError(f"Unknown partition method '{method}'")
+
+
+def generate_partition_query(original_query, condition):
+    # Select one partition of the query
+    base_query = original_query.strip().rstrip(';')
+    return f"SELECT * FROM ({base_query}) partition_query WHERE {condition}"
+
+
+def fetch_partitions(query, pool, partitions, chunk_size, arraysize, prefetch_rows,
+                     binds=None, run_log=None):
+    # Fetch every partition at once on its own connection and yield the
+    # chunks in partition order. Each partition only runs PARTITION_QUEUE_CHUNKS
+    # ahead of the writer, so the later ones wait instead of piling up in memory.
+    done = object()
+    stop = threading.Event()
+    queues = [queue.Queue(maxsize=PARTITION_QUEUE_CHUNKS) for _ in partitions]
+
+    def put(partition_queue, item):
+        # Wait for room in the queue, unless the export has stopped
+        while not stop.is_set():
+            try:
+                partition_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def fetch_partition(partition_queue, condition, params):
+        try:
+            for chunk_df in read_cursor_batches(
+                    pool, generate_partition_query(query, condition),
+                    {**(binds or {}), **params}, chunk_size, arraysize, prefetch_rows,
+                    run_log):
+                if not put(partition_queue, chunk_df):
+                    break
+        except Exception as e:
+            put(partition_queue, e)
+        finally:
+            put(partition_queue, done)
+
+    with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+        for partition_queue, (condition, params) in zip(queues, partitions):
+            executor.submit(fetch_partition, partition_queue, condition, params)
+
+        try:
+            for partition_queue in queues:
+                while True:
+                    item = partition_queue.get()
+                    if item is done:
+                        break
+                    if isinstance(item, Exception):
+                        raise item
+
+                    yield item
+        finally:
+            # Let the other workers finish early if the export failed
+            stop.set()
+
+
+def export_partitions_to_parts(query, pool, partitions, chunk_size, arraysize,
+                               prefetch_rows, output_filepath, write_options, total_rows=None,
+                               binds=None, desc='Fetching data', totals=None, run_log=None):
+    # Fetch every partition at once and write each one to its own file
+    base_path, extension = os.path.splitext(output_filepath)
+    if output_filepath.endswith('.csv.gz'):
+        base_path, extension = output_filepath[:-7], '.csv.gz'
+
+    part_paths = [f'{base_path}_p{number:02}{extension}'
+                  for number in range(1, len(partitions) + 1)]
+    progress_lock = threading.Lock()
+    if totals is None:
+        totals = {'rows': 0, 'bytes': 0}
+
+    with progress_bar(total_rows, desc) as pbar:
+        def export_partition(part_path, condition, params):
+            def counted_chunks():
+                for chunk_df in read_cursor_batches(
+                        pool, generate_partition_query(query, condition),
+                        {**(binds or {}), **params}, chunk_size, arraysize, prefetch_rows,
+                        run_log):
+                    yield chunk_df
+                    with progress_lock:
+                        update_progress(pbar, chunk_df, totals)
+
+            write_data(log_writes(counted_chunks(), run_log), part_path, **write_options)
+
+        with ThreadPoolExecutor(max_workers=len(partitions)) as executor:
+            futures = [executor.submit(export_partition, part_path, condition, params)
+                       for part_path, (condition, params) in zip(part_paths, partitions)]
+            for future in futures:
+                future.result()
+
+    return part_paths
+
+
+def write_xlsx_streaming(data_chunks, output_filepath, query,
+                         max_rows_per_sheet=MAX_ROWS_PER_SHEET, max_sheets_per_workbook=None):
+    # Append each chunk straight to a write-only workbook so only one chunk
+    # is held in memory at a time. Rolls over to Data_2, Data_3, ... when a
+    # sheet is full, and to a new workbook after max_sheets_per_workbook.
+    base_path, extension = os.path.splitext(output_filepath)
+    first_workbook = Workbook(write_only=True)
+    workbook = first_workbook
+    workbook_path = output_filepath
+    sheets_in_workbook = 0
+    data_sheet = None
+    sheet_rows = 0
+    header = None
+    rows_written = 0
+    # (sheet, file, first row, last row) for each part written
+    parts = []
+
+    def start_sheet():
+        nonlocal workbook, workbook_path, sheets_in_workbook, data_sheet, sheet_rows
+
+        if max_sheets_per_workbook and sheets_in_workbook >= max_sheets_per_workbook:
+            # The first workbook stays open until the end for the index
+            if workbook is not first_workbook:
+                save_workbook(workbook, workbook_path, query)
+            workbook = Workbook(write_only=True)
+            workbook_path = f'{base_path}_{len(parts) // max_sheets_per_workbook + 1}{extension}'
+            sheets_in_workbook = 0
+
+        sheet_name = 'Data' if not parts else f'Data_{len(parts) + 1}'
+        data_sheet = workbook.create_sheet(sheet_name)
+        if header is not None:
+            data_sheet.append(header)
+        sheets_in_workbook += 1
+        sheet_rows = 0
+        parts.append([sheet_name, os.path.basename(workbook_path),
+                      rows_written + 1, rows_written])
+
+    start_sheet()
+
+    for chunk_df in data_chunks:
+        if header is None:
+            header = list(chunk_df.columns)
+            data_sheet.append(header)
+
+        # Excel has no NaN/NaT, write empty cells instead
+        chunk_df = chunk_df.astype(object).where(chunk_df.notna(), None)
+        for row in chunk_df.itertuples(index=False, name=None):
+            if sheet_rows >= max_rows_per_sheet:
+                start_sheet()
+
+            data_sheet.append(row)
+            sheet_rows += 1
+            rows_written += 1
+            parts[-1][3] = rows_written
+
+    if workbook is not first_workbook:
+        save_workbook(workbook, workbook_path, query)
+
+    # Only list the parts when the export did not fit in one sheet
+    if len(parts) > 1:
+        index_sheet = first_workbook.create_sheet('Index')
+        index_sheet.append(['Sheet', 'File', 'First Row', 'Last Row'])
+        for part in parts:
+            index_sheet.append(part)
+
+    save_workbook(first_workbook, output_filepath, query)
+
+    # Every workbook written, in order
+    folder = os.path.dirname(output_filepath)
+    return [os.path.join(folder, workbook_file)
+            for workbook_file in dict.fromkeys(part[1] for part in parts)]
+
+
+def save_workbook(workbook, workbook_path, query):
+    # Every workbook gets the query it was exported from
+    query_sheet = workbook.create_sheet('Query')
+    query_sheet.append(['Query'])
+    query_sheet.append([query])
+    workbook.save(workbook_path)
+
+
+def write_xlsx_pandas(data_chunks, output_filepath, query):
+    # Collect every chunk into one DataFrame and save it with pandas
+    data_frames = list(data_chunks)
+    if data_frames:
+        df = pd.concat(data_frames, ignore_index=True)
+    else:
+        df = pd.DataFrame()
+
+    with pd.ExcelWriter(output_filepath, engine='openpyxl') as writer:
+        df.to_excel(writer, index=False, sheet_name='Data')
+        # Create dataframe with the query text
+        query_df = pd.DataFrame([query], columns=['Query'])
+        query_df.to_excel(writer, index=False, sheet_name='Query',
+                          startrow=0, startcol=0)
+
+
+def import_pyarrow():
+    # pyarrow is only needed for the parquet and feather formats
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as e:
+        missing_package = str(e).split()[-1]
+        print(f"Missing required package: {missing_package}.")
+        print(f"pip install {missing_package}")
+        exit(1)
+
+    return pyarrow
+
+
+def arrow_frame(table):
+    # An Arrow table read back as a chunk, noting the columns whose type the
+    # values alone don't show, so they keep it when written again
+    pa = import_pyarrow()
+    chunk_df = table.to_pandas()
+    arrow_kinds = {}
+
+    for field in table.schema:
+        arrow_kind = (field.metadata or {}).get(b'arrow_kind', b'').decode()
+        if not arrow_kind:
+            if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+                arrow_kind = 'string'
+            elif pa.types.is_binary(field.type) or pa.types.is_large_binary(field.type):
+                arrow_kind = 'binary'
+            elif pa.types.is_boolean(field.type):
+                arrow_kind = 'bool'
+            elif pa.types.is_decimal(field.type) and field.type.scale == 0:
+                arrow_kind = f'decimal:{field.type.precision}'
+        if not arrow_kind:
+            continue
+        arrow_kinds[field.name] = arrow_kind
+
+        # Whole numbers come back as Decimal, and unconstrained NUMBERs kept
+        # exactly as text, the chunks carry them as int/float
+        if arrow_kind.startswith('decimal'):
+            chunk_df[field.name] = pd.Series(
+                [None if value is None else int(value) for value in chunk_df[field.name]],
+                index=chunk_df.index, dtype=object)
+        elif arrow_kind == 'number' and pa.types.is_string(field.type):
+            chunk_df[field.name] = pd.Series(
+                [None if pd.isna(value) else whole_or_float(Decimal(value))
+                 for value in chunk_df[field.name]],
+                index=chunk_df.index, dtype=object)
+
+    chunk_df.attrs['arrow_kinds'] = arrow_kinds
+    return chunk_df
+
+
+def arrow_type(pa, arrow_kind, exact_numbers=False):
+    if arrow_kind == 'string':
+        return pa.string()
+    if arrow_kind == 'binary':
+        return pa.binary()
+    if arrow_kind == 'bool':
+        return pa.bool_()
+    if arrow_kind == 'number':
+        return pa.string() if exact_numbers else pa.float64()
+    return pa.decimal128(int(arrow_kind.split(':')[1]), 0)
+
+
+def frame_to_arrow(chunk_df, schema=None, metadata=None, exact_numbers=False):
+    # Convert a chunk to an Arrow table. Without a schema (the first chunk),
+    # one is made that every later chunk will fit, and returned with the table.
+    # Unconstrained NUMBERs are stored as doubles, or with exact_numbers as
+    # text so they read back as the same ints and floats.
+    pa = import_pyarrow()
+    arrow_kinds = {name: kind for name, kind in chunk_df.attrs.get('arrow_kinds', {}).items()
+                   if name in chunk_df.columns}
+    numbers = [name for name, kind in arrow_kinds.items() if kind == 'number']
+    if numbers and exact_numbers:
+        chunk_df = chunk_df.assign(**{
+            name: chunk_df[name].map(lambda value: None if pd.isna(value) else str(value))
+            for name in numbers})
+    elif numbers:
+        chunk_df = chunk_df.astype({name: 'float64' for name in numbers})
+
+    if schema is None:
+        # Object columns get the type the cursor described, the rest the one
+        # their dtype shows. Only a column of a type not listed in
+        # get_arrow_kinds can be all NULL with no type yet, it is taken to be
+        # text. The kinds the Arrow type alone doesn't show are noted on the
+        # field so the column reads back the same.
+        inferred = pa.Schema.from_pandas(
+            chunk_df.assign(**{name: None for name in arrow_kinds}), preserve_index=False)
+        schema = pa.schema([
+            pa.field(field.name, arrow_type(pa, arrow_kinds[field.name], exact_numbers),
+                     metadata={'arrow_kind': arrow_kinds[field.name]}
+                     if arrow_kinds[field.name] not in ('string', 'bool') else None)
+            if field.name in arrow_kinds
+            else field.with_type(pa.string()) if pa.types.is_null(field.type)
+            else field
+            for field in inferred
+        ], metadata={**(inferred.metadata or {}), **(metadata or {})})
+
+    return pa.Table.from_pandas(chunk_df, schema=schema, preserve_index=False), schema
+
+
+def chunks_to_arrow(data_chunks, metadata):
+    # Convert each chunk to an Arrow table using the first chunk's schema,
+    # with the export details stored in the schema metadata
+    pa = import_pyarrow()
+    schema = None
+
+    for chunk_df in data_chunks:
+        table, schema = frame_to_arrow(chunk_df, schema, metadata)
+        yield table
+
+    # Nothing was fetched, still write a file with the metadata
+    if schema is None:
+        yield pa.table({}).replace_schema_metadata(metadata)
+
+
+def write_parquet(data_chunks, output_filepath, metadata):
+    # Write each chunk as a row group of one parquet file
+    pa = import_pyarrow()
+    writer = None
+
+    try:
+        for table in chunks_to_arrow(data_chunks, metadata):
+            if writer is None:
+                writer = pa.parquet.ParquetWriter(
+                    output_filepath, table.schema, compression='zstd')
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_feather(data_chunks, output_filepath, metadata):
+    # Feather V2 is the Arrow IPC file format, written one batch per chunk
+    pa = import_pyarrow()
+    writer = None
+
+    try:
+        for table in chunks_to_arrow(data_chunks, metadata):
+            if writer is None:
+                writer = pa.ipc.new_file(
+                    output_filepath, table.schema,
+                    options=pa.ipc.IpcWriteOptions(compression='zstd'))
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def write_csv_gz(data_chunks, output_filepath, metadata, append=False):
+    # Append each chunk to a gzip CSV, the export details go in a sidecar file.
+    # With append, the rows are added to the end of an existing export.
+    metadata_filepath = f'{output_filepath}.json'
+    rows_written = 0
+    if append and os.path.exists(output_filepath):
+        with open(metadata_filepath) as metadata_file:
+            rows_written = json.load(metadata_file)['rows']
+        mode = 'at'
+    else:
+        mode = 'wt'
+
+    with gzip.open(output_filepath, mode, newline='', encoding='utf-8') as csv_file:
+        for chunk_df in data_chunks:
+            chunk_df.to_csv(csv_file, index=False, header=rows_written == 0)
+            rows_written += len(chunk_df)
+
+    with open(metadata_filepath, 'w') as metadata_file:
+        json.dump({**metadata, 'rows': rows_written}, metadata_file, indent=2)
+
+
+def get_cache_key(query, database, binds=None):
+    # The same query text, database and bind values give the same results
+    normalized_query = re.sub(r'\s+', ' ', query).strip().rstrip(';').strip()
+    key_source = json.dumps(
+        {'query': normalized_query, 'database': database, 'binds': binds or {}},
+        sort_keys=True, default=str)
+    return hashlib.sha256(key_source.encode('utf-8')).hexdigest()
+
+
+def read_cache(cache_folder, cache_key, ttl_hours):
+    # Cached details and chunks for the key, or None if not cached or expired
+    entry_folder = os.path.join(cache_folder, cache_key)
+
+    try:
+        with open(os.path.join(entry_folder, 'cache.json')) as cache_file:
+            cache_info = json.load(cache_file)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+    if time.time() - cache_info['created'] > ttl_hours * 3600:
+        shutil.rmtree(entry_folder, ignore_errors=True)
+        return None
+
+    # Mark the entry as recently used so it is evicted last
+    os.utime(entry_folder)
+
+    def cached_chunks():
+        for batch_file in cache_info['batches']:
+            yield arrow_frame(import_pyarrow().parquet.read_table(
+                os.path.join(entry_folder, batch_file)))
+
+    return cache_info, cached_chunks()
+
+
+def cache_chunks(data_chunks, cache_folder, cache_key, metadata):
+    # Save each chunk to the cache as it passes through to the writer. The
+    # entry only becomes visible once every chunk has been saved. If a chunk
+    # can't be saved the export goes on without the cache.
+    entry_folder = os.path.join(cache_folder, cache_key)
+    # Jobs run in threads, so each writer gets a folder of its own
+    partial_folder = f'{entry_folder}.partial{os.getpid()}_{threading.get_ident()}'
+    batches = []
+    schema = None
+    rows = 0
+
+    try:
+        try:
+            os.makedirs(partial_folder, exist_ok=True)
+            caching = True
+        except OSError as e:
+            print(f"Could not cache the results, exporting without the cache: {e}")
+            caching = False
+
+        for chunk_df in data_chunks:
+            if caching:
+                # Every batch gets the first one's schema, so columns keep their types
+                batch_file = f'batch_{len(batches):06}.parquet'
+                try:
+                    table, schema = frame_to_arrow(chunk_df, schema, exact_numbers=True)
+                    import_pyarrow().parquet.write_table(
+                        table, os.path.join(partial_folder, batch_file))
+                    batches.append(batch_file)
+                    rows += len(chunk_df)
+                except (OSError, TypeError, ValueError) as e:
+                    print(f"Could not cache the results, exporting without the cache: {e}")
+                    caching = False
+            yield chunk_df
+
+        if caching:
+            cache_info = {
+                **metadata,
+                'created': time.time(),
+                'rows': rows,
+                'batches': batches
+            }
+            try:
+                with open(os.path.join(partial_folder, 'cache.json'), 'w') as cache_file:
+                    json.dump(cache_info, cache_file, indent=2)
+                shutil.rmtree(entry_folder, ignore_errors=True)
+                os.replace(partial_folder, entry_folder)
+            except OSError as e:
+                print(f"Could not cache the results: {e}")
+    finally:
+        # Nothing is left behind when caching failed or the export stopped early
+        shutil.rmtree(partial_folder, ignore_errors=True)
+
+
+def prune_cache(cache_folder, ttl_hours, max_mb):
+    # Remove expired and abandoned entries, then the least recently used
+    # ones until the cache fits in max_mb
+    if not os.path.isdir(cache_folder):
+        return
+
+    now = time.time()
+    entries = []
+    for entry in os.scandir(cache_folder):
+        if not entry.is_dir():
+            continue
+
+        last_used = entry.stat().st_mtime
+        if now - last_used > ttl_hours * 3600:
+            shutil.rmtree(entry.path, ignore_errors=True)
+            continue
+
+        size = sum(batch.stat().st_size for batch in os.scandir(entry.path))
+        entries.append((last_used, size, entry.path))
+
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total_size <= max_mb * 1024 * 1024:
+            break
+        shutil.rmtree(entry_path, ignore_errors=True)
+        total_size -= size
+
+
+def log_writes(data_chunks, run_log):
+    # Time the writer spends on each chunk: from handing it over until the
+    # next one is asked for
+    for chunk_df in data_chunks:
+        start_time = time.perf_counter()
+        yield chunk_df
+        log_stage(run_log, 'write', start_time, rows=len(chunk_df))
+
+
+def write_data(data_chunks, output_filepath, output_format, metadata, writer='streaming',
+               max_rows_per_sheet=MAX_ROWS_PER_SHEET, max_sheets_per_workbook=None,
+               append=False):
+    # Save the data and the query in the chosen format, returns the files written
+    if output_format == 'parquet':
+        write_parquet(data_chunks, output_filepath, metadata)
+    elif output_format == 'feather':
+        write_feather(data_chunks, output_filepath, metadata)
+    elif output_format == 'csv.gz':
+        write_csv_gz(data_chunks, output_filepath, metadata, append)
+    elif output_format != 'xlsx':
+        raise ValueError(f"Unknown output format '{output_format}'")
+    elif writer == 'streaming':
+        return write_xlsx_streaming(data_chunks, output_filepath, metadata['query'],
+                                    max_rows_per_sheet, max_sheets_per_workbook)
+    else:
+        write_xlsx_pandas(data_chunks, output_filepath, metadata['query'])
+
+    return [output_filepath]
+
+
+def generate_delta_query(original_query, watermark_column):
+    # Only the rows past the previous run's high-water mark
+    base_query = original_query.strip().rstrip(';')
+    return f"SELECT * FROM ({base_query}) delta_query WHERE {watermark_column} > :watermark"
+
+
+def load_watermarks(watermarks_filepath):
+    # High-water marks of earlier delta exports, keyed by OUTPUT_FILENAME|DATABASE
+    try:
+        with open(watermarks_filepath) as watermarks_file:
+            return json.load(watermarks_file)
+    except FileNotFoundError:
+        return {}
+
+
+def save_watermark(watermarks_filepath, watermark_key, watermark):
+    # Re-read the file so marks saved by other exports in the meantime are kept
+    watermarks = load_watermarks(watermarks_filepath)
+    watermarks[watermark_key] = watermark
+
+    temporary_filepath = f'{watermarks_filepath}.tmp'
+    with open(temporary_filepath, 'w') as watermarks_file:
+        json.dump(watermarks, watermarks_file, indent=2)
+    os.replace(temporary_filepath, watermarks_filepath)
+
+
+def encode_watermark(value):
+    # JSON has no dates, keep them as ISO text with a type marker
+    if isinstance(value, datetime):
+        return {'type': 'datetime', 'value': value.isoformat()}
+    return {'type': type(value).__name__, 'value': value}
+
+
+def decode_watermark(watermark):
+    if watermark['type'] == 'datetime':
+        return datetime.fromisoformat(watermark['value'])
+    return watermark['value']
+
+
+def track_watermark(data_chunks, watermark_column, tracked):
+    # Keep the highest watermark value seen in tracked['value']
+    for chunk_df in data_chunks:
+        column_max = chunk_df[find_column(chunk_df, watermark_column)].max()
+        if not pd.isna(column_max):
+            column_max = to_bind_value(column_max)
+            if tracked['value'] is None or column_max > tracked['value']:
+                tracked['value'] = column_max
+        yield chunk_df
+
+
+def read_previous_export(filepaths, output_format, chunk_size):
+    # Read an earlier export back in chunks so it can be merged with new rows
+    for filepath in filepaths:
+        if output_format == 'parquet':
+            pa = import_pyarrow()
+            for batch in pa.parquet.ParquetFile(filepath).iter_batches(chunk_size):
+                yield arrow_frame(pa.Table.from_batches([batch]))
+        elif output_format == 'feather':
+            pa = import_pyarrow()
+            with pa.memory_map(filepath) as source:
+                reader = pa.ipc.open_file(source)
+                for i in range(reader.num_record_batches):
+                    yield arrow_frame(pa.Table.from_batches([reader.get_batch(i)]))
+        else:
+            workbook = load_workbook(filepath, read_only=True)
+            try:
+                for sheet_name in workbook.sheetnames:
+                    if sheet_name != 'Data' and not sheet_name.startswith('Data_'):
+                        continue
+
+                    rows = workbook[sheet_name].iter_rows(values_only=True)
+                    header = next(rows, None)
+                    batch = []
+                    for row in rows:
+                        batch.append(row)
+                        if len(batch) >= chunk_size:
+                            yield pd.DataFrame.from_records(batch, columns=header)
+                            batch = []
+                    if batch:
+                        yield pd.DataFrame.from_records(batch, columns=header)
+            finally:
+                workbook.close()
+
+
+def get_exports_folder():
+    # Determine the user's Documents/exports directory
+    onedrive_folder = os.environ.get('OneDrive')
+    if onedrive_folder:
+        documents_folder = os.path.join(onedrive_folder, "Documents")
+    else:
+        # Fallback if onedrive not available
+        documents_folder = os.path.join(os.path.expanduser("~"), "Documents")
+
+    exports_folder = os.path.join(documents_folder, "exports")
+    os.makedirs(exports_folder, exist_ok=True)
+    return exports_folder
+
+
+def get_job_settings(job=None):
+    # The settings for one export: the values above, overridden by the job
+    settings = {name.lower(): globals()[name] for name in JOB_SETTINGS}
+
+    unknown = set(job or {}) - set(settings)
+    if unknown:
+        raise ValueError(f"Unknown job settings: {', '.join(sorted(unknown))}")
+
+    settings.update(job or {})
+    if settings['database'] not in DATABASES or settings['database'] == 'CREDENTIALS':
+        raise ValueError(f"Unknown database '{settings['database']}'")
+
+    return settings
+
+
+def load_jobs(jobs_filepath):
+    # A job file is a JSON (or YAML, with PyYAML installed) list of job settings
+    with open(jobs_filepath) as jobs_file:
+        if jobs_filepath.lower().endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                print("Missing required package: pyyaml.")
+                print("pip install pyyaml")
+                exit(1)
+            jobs = yaml.safe_load(jobs_file)
+        else:
+            jobs = json.load(jobs_file)
+
+    if not isinstance(jobs, list):
+        raise ValueError(f"Job file '{jobs_filepath}' should hold a list of jobs")
+
+    return [get_job_settings(job) for job in jobs]
+
+
+def run_export(settings, refresh=False, pool_size=5):
+    # Run one export from fetch to file, returns what was written
+    load_dependencies()
+    query = settings['query']
+    chunk_size = settings['chunk_size']
+    output_format = settings['output_format']
+    watermark_column = settings['watermark_column']
+    parallel = settings['parallel_partitions'] > 1
+    parts = parallel and settings['parallel_output'] == 'parts'
+    progress_desc = f"Fetching {settings['output_filename']}"
+    totals = {'rows': 0, 'bytes': 0}
+    run_log = [] if settings['run_log'] else None
+    run_start_time = time.perf_counter()
+
+    exports_folder = get_exports_folder()
+
+    # Construct the output file
+    current_datetime = datetime.now().strftime('%Y%m%d%H%M%S')
+    filename = f'{current_datetime}_{settings["output_filename"]}.{output_format}'
+    output_filepath = os.path.join(exports_folder, filename)
+
+    # Where the data came from, for formats without a Query sheet
+    metadata = {
+        'query': query,
+        'database': settings['database'],
+        'exported_at': datetime.now().isoformat(timespec='seconds')
+    }
+    write_options = {
+        'output_format': output_format,
+        'metadata': metadata,
+        'writer': settings['writer'],
+        'max_rows_per_sheet': settings['max_rows_per_sheet'],
+        'max_sheets_per_workbook': settings['max_sheets_per_workbook']
+    }
+
+    # Delta exports only fetch the rows past the previous run's high-water mark
+    watermarks_filepath = os.path.join(exports_folder, '.watermarks.json')
+    watermark_key = f'{settings["output_filename"]}|{settings["database"]}'
+    previous_watermark = None
+    previous_files = []
+    append = False
+    export_query = query
+    export_binds = dict(settings['binds'] or {})
+
+    if watermark_column:
+        if parts:
+            raise ValueError("Delta exports can't be written as part files")
+
+        previous_watermark = load_watermarks(watermarks_filepath).get(watermark_key)
+        joins_previous = output_format == 'csv.gz' or settings['delta_output'] == 'merge'
+
+        # Start over with a full export when the watermark column changed, or
+        # when the new rows should join a previous export that is gone
+        if previous_watermark and (
+                previous_watermark['column'] != watermark_column.upper()
+                or joins_previous and (
+                    previous_watermark['format'] != output_format
+                    or not all(os.path.exists(path) for path in previous_watermark['files']))):
+            print("Previous delta export can't be continued, exporting everything.")
+            previous_watermark = None
+
+    if previous_watermark:
+        export_query = generate_delta_query(query, watermark_column)
+        export_binds['watermark'] = decode_watermark(previous_watermark)
+        print(f"Fetching rows with {watermark_column} after {previous_watermark['value']}.")
+
+        if output_format == 'csv.gz':
+            output_filepath = previous_watermark['files'][0]
+            append = True
+        elif settings['delta_output'] == 'merge':
+            previous_files = previous_watermark['files']
+
+    # The cache is skipped for part files, for delta queries (an empty delta
+    # would be replayed until the cache expires) and when pyarrow is not installed
+    cache_folder = os.path.join(exports_folder, '.cache')
+    use_cache = (settings['use_cache'] and not parts and not previous_watermark
+                 and importlib.util.find_spec('pyarrow') is not None)
+    cache_key = None
+    cached = None
+    if use_cache:
+        cache_key = get_cache_key(export_query, settings['database'], export_binds)
+        if not refresh:
+            cached = read_cache(cache_folder, cache_key, settings['cache_ttl_hours'])
+
+    if cached is not None:
+        cache_info, data_chunks = cached
+        total_rows = cache_info['rows']
+        print(f"Using results cached at "
+              f"{datetime.fromtimestamp(cache_info['created']):%Y-%m-%d %H:%M:%S}, "
+              f"run with --refresh to fetch them again.")
+    else:
+        # Only connect once the data really has to come from Oracle
+        pool = get_pool(settings['database'], max(pool_size, settings['parallel_partitions']))
+
+        if parallel:
+            partitions = get_partitions(
+                export_query, pool, settings['parallel_partitions'],
+                settings['partition_method'], settings['partition_key'],
+                settings['partition_table'], export_binds)
+
+        total_rows = get_total_rows(export_query, pool, settings['progress_total'],
+                                    settings['progress_table'], export_binds, run_log)
+        if total_rows is not None:
+            print(f'Rows to fetch ({settings["progress_total"]}): {total_rows}')
+
+        if parts:
+            data_chunks = None
+            files_written = export_partitions_to_parts(
+                export_query, pool, partitions, chunk_size, settings['arraysize'],
+                settings['prefetch_rows'], output_filepath, write_options, total_rows,
+                export_binds, progress_desc, totals, run_log)
+        elif parallel:
+            data_chunks = fetch_partitions(
+                export_query, pool, partitions, chunk_size, settings['arraysize'],
+                settings['prefetch_rows'], export_binds, run_log)
+        elif settings['fetch_mode'] == 'stream':
+            data_chunks = stream_data(
+                export_query, pool, chunk_size, settings['arraysize'],
+                settings['prefetch_rows'], export_binds, run_log)
+        else:
+            data_chunks = fetch_data_in_chunks(
+                export_query, pool, chunk_size, settings['pagination'],
+                settings['pagination_key'], export_binds, run_log)
+
+        if data_chunks is not None and use_cache:
+            data_chunks = cache_chunks(data_chunks, cache_folder, cache_key, metadata)
+
+    if data_chunks is not None:
+        tracked = {'value': None}
+        if watermark_column:
+            data_chunks = track_watermark(data_chunks, watermark_column, tracked)
+
+        # Progress and totals count the rows fetched this run, not the rows
+        # of the previous export a merged delta starts with
+        data_chunks = itertools.chain(
+            read_previous_export(previous_files, output_format, chunk_size),
+            track_progress(data_chunks, total_rows, progress_desc, totals))
+
+        files_written = write_data(
+            log_writes(data_chunks, run_log),
+            output_filepath, append=append, **write_options)
+
+        # The merged export replaces the previous one
+        for previous_file in previous_files:
+            if previous_file not in files_written:
+                os.remove(previous_file)
+
+        if watermark_column and (tracked['value'] is not None or previous_watermark):
+            if tracked['value'] is not None:
+                watermark = encode_watermark(tracked['value'])
+            else:
+                # Nothing new, keep the mark from last time
+                watermark = {key: previous_watermark[key] for key in ('type', 'value')}
+            watermark.update({
+                'column': watermark_column.upper(),
+                'format': output_format,
+                'files': files_written,
+                'updated': datetime.now().isoformat(timespec='seconds')
+            })
+            save_watermark(watermarks_filepath, watermark_key, watermark)
+
+    if use_cache:
+        prune_cache(cache_folder, settings['cache_ttl_hours'], settings['cache_max_mb'])
+
+    if run_log is not None:
+        log_stage(run_log, 'export', run_start_time, rows=totals['rows'],
+                  bytes=totals['bytes'], cached=cached is not None,
+                  files=[os.path.basename(path) for path in files_written])
+        write_run_log(run_log, f'{files_written[0]}.runlog.jsonl', {
+            'run': current_datetime,
+            'job': settings['output_filename'],
+            'database': settings['database']
+        })
+
+    return {
+        'folder': exports_folder,
+        'files': files_written,
+        'rows': totals['rows']
+    }
+
+
+def format_elapsed(elapsed_time):
+    # Seconds as HH:MM:SS
+    hours, rem = divmod(elapsed_time, 3600)
+    minutes, seconds = divmod(rem, 60)
+    return f'{int(hours):02}:{int(minutes):02}:{int(seconds):02}'
+
+
+def run_jobs(jobs, workers, refresh=False):
+    # Run every job, workers at a time, then summarize how each one went
+    def run_job(settings):
+        start_time = time.time()
+        try:
+            result = run_export(settings, refresh, pool_size=workers)
+            status = 'ok'
+        except Exception as e:
+            result = {'files': [], 'rows': 0}
+            status = f'failed: {e}'
+        return settings, result, status, time.time() - start_time
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        outcomes = list(executor.map(run_job, jobs))
+
+    print()
+    print(f'{"Job":<30} {"Database":<8} {"Rows":>12} {"Time":>8}  Result')
+    for settings, result, status, elapsed_time in outcomes:
+        files = ', '.join(os.path.basename(path) for path in result['files'])
+        print(f'{settings["output_filename"][:30]:<30} {settings["database"]:<8} '
+              f'{result["rows"]:>12,} {format_elapsed(elapsed_time):>8}  '
+              f'{files if status == "ok" else status}')
+
+    return all(status == 'ok' for _, _, status, _ in outcomes)
+
+
+def run_profiled(profiler, run_function, args):
+    # Run under cProfile or tracemalloc and save the report with the exports
+    report_filepath = os.path.join(
+        get_exports_folder(),
+        f'{datetime.now().strftime("%Y%m%d%H%M%S")}_profile_{profiler}')
 
-    if from_pos == -1:
-        raise ValueError("The query does not contain a 'FROM' keyword")
+    if profiler == 'cprofile':
+        import cProfile
+        import pstats
 
-    count_query = f"SELECT COUNT(*) {original_query[from_pos:]}"
-    return count_query
+        profile = cProfile.Profile()
+        try:
+            profile.runcall(run_function, args)
+        finally:
+            profile.dump_stats(f'{report_filepath}.prof')
+            pstats.Stats(profile).sort_stats('cumulative').print_stats(20)
+            print(f'Profile saved to: {report_filepath}.prof')
+    else:
+        import tracemalloc
 
+        tracemalloc.start(25)
+        try:
+            run_function(args)
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            top_stats = tracemalloc.take_snapshot().statistics('lineno')
+            tracemalloc.stop()
 
-def fetch_data_in_chunks(query, engine, chunk_size):
-    # Execute query in chunks and provide progress
-    offset = 0
+            with open(f'{report_filepath}.txt', 'w') as report_file:
+                report_file.write(f'Peak traced memory: {peak / 1024 / 1024:.1f} MB\n')
+                for stat in top_stats[:50]:
+                    report_file.write(f'{stat}\n')
+            print(f'Peak traced memory: {peak / 1024 / 1024:.1f} MB')
+            print(f'Memory report saved to: {report_filepath}.txt')
 
-    with engine.connect() as connection:
-        result = connection.execute(
-            text(f'{generate_count_query(query)}'))
-        total_rows = result.scalar()
-        print(f'Total rows to fetch: {total_rows}')
-        data_frames = []
 
-        with tqdm(total=total_rows, desc='Fetching data') as pbar:
-            while offset < total_rows:
-                chunk_query = f"{query} OFFSET {offset} ROWS FETCH NEXT {chunk_size} ROWS ONLY"
-                chunk_df = pd.read_sql(text(chunk_query), connection)
-                data_frames.append(chunk_df)
-                offset += chunk_size
-                pbar.update(len(chunk_df))
-                # Adding a slight delay to show progress updates clearly
-                time.sleep(0.1)
+def describe_export(settings):
+    # Show what an export would run, without connecting to anything
+    if settings['parallel_partitions'] > 1:
+        fetch = (f"{settings['parallel_partitions']} {settings['partition_method']} partitions "
+                 f"on {settings['partition_key']}, written as {settings['parallel_output']}")
+    elif settings['fetch_mode'] == 'stream':
+        fetch = 'one streamed cursor'
+    else:
+        fetch = f"chunks of {settings['chunk_size']}, {settings['pagination']} pagination"
 
-    return pd.concat(data_frames, ignore_index=True)
+    print(f"{settings['output_filename']} ({settings['database']}, {settings['output_format']})")
+    print(f"  Fetch:    {fetch}")
+    if settings['watermark_column']:
+        print(f"  Delta on: {settings['watermark_column']} ({settings['delta_output']})")
+    print(f"  Progress: {settings['progress_total']}")
+    print(f"  Query:    {' '.join(settings['query'].split())}")
+    if settings['binds']:
+        print(f"  Binds:    {settings['binds']}")
 
 
-# When did we start?
-start_time = time.time()
+def run(args):
+    # Run the job file, or the single export configured at the top
+    jobs = load_jobs(args.jobs) if args.jobs else [get_job_settings()]
 
+    if args.dry_run:
+        for settings in jobs:
+            describe_export(settings)
+        return
 
-df = fetch_data_in_chunks(QUERY, engine, CHUNK_SIZE)
+    # When did we start?
+    start_time = time.time()
 
+    if args.jobs:
+        succeeded = run_jobs(jobs, args.workers, args.refresh)
+        print(f'All jobs completed in {format_elapsed(time.time() - start_time)}.')
+        if not succeeded:
+            exit(1)
+        return
 
-# Determine the user's Documents/exports directory
-onedrive_folder = os.environ.get('OneDrive')
-if onedrive_folder:
-    documents_folder = os.path.join(onedrive_folder, "Documents")
-else:
-    # Fallback if onedrive not available
-    documents_folder = os.path.join(os.path.expanduser("~"), "Documents")
+    result = run_export(jobs[0], args.refresh)
 
-exports_folder = os.path.join(documents_folder, "exports")
-os.makedirs(exports_folder, exist_ok=True)
+    # When did we end?
+    filename = ', '.join(os.path.basename(path) for path in result['files'])
+    print(
+        f'Data fetching and saving completed in {format_elapsed(time.time() - start_time)}.')
+    print(f'File saved to: {result["folder"]} as {filename}')
 
-# Construct the output file
-current_datetime = datetime.now().strftime('%Y%m%d%H%M%S')
-filename = f'{current_datetime}_{OUTPUT_FILENAME}.xlsx'
-output_filepath = os.path.join(exports_folder, filename)
 
-# Save the data and the query to excel
-with pd.ExcelWriter(output_filepath, engine='openpyxl') as writer:
-    df.to_excel(writer, index=False, sheet_name='Data')
-    # Create dataframe with the query text
-    query_df = pd.DataFrame([QUERY], columns=['Query'])
-    query_df.to_excel(writer, index=False, sheet_name='Query',
-                      startrow=0, startcol=0)
+def main():
+    parser = argparse.ArgumentParser(
+        description='Export QUERY from DATABASE to Documents/exports.')
+    parser.add_argument('--refresh', action='store_true',
+                        help='fetch from Oracle even if the results are cached')
+    parser.add_argument('--jobs', metavar='FILE',
+                        help='run every export listed in a JSON/YAML job file')
+    parser.add_argument('--workers', type=int, default=JOB_WORKERS,
+                        help=f'jobs to run at the same time (default {JOB_WORKERS})')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='show what would be exported without connecting')
+    parser.add_argument('--profile', choices=['cprofile', 'tracemalloc'],
+                        help='profile the run and save the report to Documents/exports')
+    args = parser.parse_args()
 
-# When did we end?
-end_time = time.time()
-elapsed_time = end_time - start_time
+    if args.profile:
+        run_profiled(args.profile, run, args)
+    else:
+        run(args)
 
-hours, rem = divmod(elapsed_time, 3600)
-minutes, seconds = divmod(rem, 60)
 
-print(
-    f'Data fetching and saving completed in {int(hours):02}:{int(minutes):02}:{int(seconds):02}.')
-print(f'File saved to: {exports_folder} as {filename}')
+if __name__ == "__main__":
+    main()